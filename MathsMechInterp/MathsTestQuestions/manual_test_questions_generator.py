@@ -367,8 +367,9 @@ def make_maths_n4_questions_and_answers(cfg):
 def make_maths_test_questions_and_answers(cfg):
     # Create a (matrix) batch of manually-curated mathematics test questions
 
-    # Start with a batch of random and manually-chosen questions
-    varied_questions = maths_data_generator_mixed_core(cfg) 
+    # Start with a batch of random and manually-chosen questions.
+    # The random batch is built on cfg.data_device, and the manual questions on the CPU
+    varied_questions = maths_data_generator_mixed_core(cfg).cpu()
 
     if cfg.perc_add > 0:
         varied_questions = torch.vstack((
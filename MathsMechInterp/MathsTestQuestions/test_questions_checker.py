@@ -1,9 +1,19 @@
+import copy
+import json
+import os
+import queue
+import types
 import torch
 from tqdm.notebook import tqdm
-from QuantaMechInterp import (to_numpy, tokens_to_string, logits_to_tokens_loss, get_question_answer_impact, sort_unique_digits, NodeLocation, a_predict_questions, loss_fn, QType)
-from MathsMechInterp.maths_complexity import get_maths_question_complexity
+from QuantaMechInterp import (to_numpy, tokens_to_string, get_question_answer_impact, sort_unique_digits, NodeLocation, loss_fn, QType)
+from MathsMechInterp.maths_complexity import get_maths_question_complexity, get_maths_complexity_codes, maths_complexity_code_to_tags, NUM_MATHS_COMPLEXITY_CODES
 from MathsMechInterp.maths_constants import MathsToken, MathsBehavior, maths_tokens_to_names
-from MathsMechInterp.maths_data_generator import maths_data_generator
+from MathsMechInterp.maths_utilities import widen_tokens
+from MathsMechInterp.maths_data_generator import maths_data_generator_indexed, maths_data_generator_exhaustive, maths_exhaustive_num_questions, MathsDataPrefetcher
+from MathsMechInterp.maths_data_profile import wilson_interval
+from MathsMechInterp.maths_failure_corpus import append_maths_failure_corpus
+from MathsMechInterp.maths_evaluation import predict_maths_questions, get_maths_eval_batch_size
+from MathsMechInterp.maths_ablation import predict_maths_questions_stacked_position_ablation
 
 
 def test_maths_questions_by_complexity(cfg, acfg, varied_questions):
@@ -12,40 +22,31 @@ def test_maths_questions_by_complexity(cfg, acfg, varied_questions):
     # Used to estimate the accuracy of the model's predictions.
     # Returns a reduced set of questions - removing questions that the model failed to answer.
 
-    num_questions = varied_questions.shape[0]
-    correct_list = [True] * num_questions
+    _, all_max_prob_tokens = predict_maths_questions(cfg, varied_questions)
+    model_questions = widen_tokens(varied_questions).to(all_max_prob_tokens.device)
 
-    all_logits = cfg.main_model(varied_questions.cuda())
-    _, all_max_prob_tokens = logits_to_tokens_loss(cfg, all_logits, varied_questions.cuda())
+    # Compare the model answer tokens to the correct answer (the last cfg.num_answer_positions tokens in each q_and_a) for all questions at once
+    correct = torch.all(all_max_prob_tokens == model_questions[:, -cfg.num_answer_positions:], dim=1)
 
+    # Count the good and bad questions in each complexity group
+    codes = get_maths_complexity_codes(cfg, model_questions)
+    good_counts = torch.bincount(codes[correct], minlength=NUM_MATHS_COMPLEXITY_CODES).tolist()
+    bad_counts = torch.bincount(codes[~correct], minlength=NUM_MATHS_COMPLEXITY_CODES).tolist()
 
-    # Evaluate and categorize each object
-    categorization_results = {}
-    for question_num in range(num_questions):
-        q_and_a = varied_questions[question_num]
-
-        # Get the last cfg.num_answer_positions tokens in the q_and_a, which is the correct answer
-        correct_answer_str = tokens_to_string(cfg, q_and_a[-cfg.num_answer_positions:])
-
-        model_answer_str = tokens_to_string(cfg, all_max_prob_tokens[question_num])
-
-        correct = (model_answer_str == correct_answer_str)
-        correct_list[question_num] = correct
-
-        major_tag, minor_tag = get_maths_question_complexity(cfg, q_and_a)
-        group_name = major_tag.value + "." + minor_tag.value
+    def complexity_group_name(code):
+        major_tag, minor_tag = maths_complexity_code_to_tags(code)
+        return major_tag.value + "." + minor_tag.value
 
-        if group_name not in categorization_results:
-            categorization_results[group_name] = [0, 0]  # Initialize counts for new group
+    if acfg.show_test_failures:
+        for question_num in torch.nonzero(~correct).flatten().tolist():
+            q_and_a_str = tokens_to_string(cfg, varied_questions[question_num])
+            model_answer_str = tokens_to_string(cfg, all_max_prob_tokens[question_num])
+            print("Failed: Q&A:", q_and_a_str, "ModelAnswer:", model_answer_str, "Complexity:", complexity_group_name(int(codes[question_num])))
 
-        if correct:
-            categorization_results[group_name][0] += 1  # Increment good count for this group
-        else:
-            categorization_results[group_name][1] += 1  # Increment bad count for this group
-
-        if acfg.show_test_failures and not correct:
-            q_and_a_str = tokens_to_string(cfg, q_and_a)
-            print("Failed: Q&A:", q_and_a_str, "ModelAnswer:", model_answer_str, "Complexity:", group_name)
+    categorization_results = {}
+    for code in range(NUM_MATHS_COMPLEXITY_CODES):
+        if good_counts[code] + bad_counts[code] > 0:
+            categorization_results[complexity_group_name(code)] = [good_counts[code], bad_counts[code]]
 
 
     # Calculate and print summary success rates per group
@@ -63,7 +64,7 @@ def test_maths_questions_by_complexity(cfg, acfg, varied_questions):
     if acfg.num_varied_successes < acfg.num_varied_questions:
         # Remove the questions that the model failed to answer as they turn up in every cell of the quanta maps
         org_size = varied_questions.shape[0]
-        varied_questions = varied_questions[torch.tensor(correct_list)]
+        varied_questions = varied_questions[correct.to(varied_questions.device)]
         new_size = varied_questions.shape[0]
         print("NEXT STEP: Understand the failure case(s). Enrich the training data to provide more examples. Retrain the model.")
         print("WORKAROUND: Have reduced 'varied_questions' size from", org_size, "to", new_size, "so can continue.")
@@ -71,6 +72,35 @@ def test_maths_questions_by_complexity(cfg, acfg, varied_questions):
     return varied_questions
 
 
+def get_maths_question_fails(cfg, acfg, questions, all_losses_raw, all_max_prob_tokens):
+    # Return a [B] boolean mask of the questions that the model got wrong. That is, the question's mean answer loss exceeds
+    # acfg.threshold and at least one answer token is wrong (as per get_question_answer_impact containing 'A').
+    # Calculated for the whole batch at once, on the device of the model outputs, without any per-question device syncs.
+    the_loss_means = loss_fn(all_losses_raw.transpose(0, 1)) # Mean over the answer positions of each question
+    correct_answers = widen_tokens(questions[:, -cfg.num_answer_positions:]).to(all_max_prob_tokens.device)
+    wrong_answers = torch.any(all_max_prob_tokens != correct_answers, dim=1)
+    return (the_loss_means > acfg.threshold) & wrong_answers
+
+
+def predict_maths_question_fails(cfg, acfg, questions, the_hooks=None):
+    # Predict the answers to the questions (with the_hooks, if any) and find the questions the model got wrong (refer get_maths_question_fails).
+    # Returns the [B] failed mask, all_losses_raw and all_max_prob_tokens
+    assert questions.shape[1] == cfg.n_ctx # Check answer is embedded in question
+    all_losses_raw, all_max_prob_tokens = predict_maths_questions(cfg, questions, the_hooks)
+
+    failed = get_maths_question_fails(cfg, acfg, questions, all_losses_raw, all_max_prob_tokens)
+
+    if acfg.show_test_failures:
+        the_loss_means = loss_fn(all_losses_raw.transpose(0, 1))
+        for question_num in torch.nonzero(failed).flatten().tolist():
+            q = questions[question_num]
+            answer_str = tokens_to_string(cfg, all_max_prob_tokens[question_num])
+            impact_str = get_question_answer_impact(cfg, q, answer_str )
+            print(tokens_to_string(cfg, q), "ModelAnswer:", answer_str, "Impact:", impact_str, "Loss:", format(float(the_loss_means[question_num]), ".4f"))
+
+    return failed, all_losses_raw, all_max_prob_tokens
+
+
 def test_maths_questions_by_impact(cfg, acfg, questions, position : int, ablate : bool ):
     # Test accuracy of model in predicting question answers. Ablates all nodes at position
     # Does NOT use UsefulInfo.* information. Used to populate UsefulInfo.useful_positions
@@ -80,29 +110,41 @@ def test_maths_questions_by_impact(cfg, acfg, questions, position : int, ablate
         assert not (the_hooks == None)
 
     acfg.ablate_node_locations = [NodeLocation(position, 0, True, 0)]  # Ablate all nodes at position
-    all_losses_raw, all_max_prob_tokens = a_predict_questions(cfg, questions, the_hooks)
 
-    num_fails = 0
-    for question_num in range(questions.shape[0]):
-        q = questions[question_num]
-        assert q.shape[0] == cfg.n_ctx # Check answer is embedded in question
+    # Only count the questions the model got wrong with a loss exceeding the threshold (because of the ablated token position)
+    failed, _, _ = predict_maths_question_fails(cfg, acfg, questions, the_hooks)
 
-        the_loss_mean = to_numpy(loss_fn(all_losses_raw[question_num]).mean())
+    return int(failed.sum()) # The only device sync
 
-        # Only show the question if the loss exceeds the threshold (because of the ablated token position)
-        if the_loss_mean > acfg.threshold:
 
-            answer_str = tokens_to_string(cfg, all_max_prob_tokens[question_num])
+def test_maths_questions_by_impact_sweep(cfg, acfg, questions, positions=None, mean_values=None):
+    # Test accuracy of model in predicting question answers, when all nodes at a position are ablated, for each of positions
+    # (default all cfg.n_ctx positions) in a few stacked forward passes (refer predict_maths_questions_stacked_position_ablation).
+    # Does NOT use UsefulInfo.* information. Used to populate UsefulInfo.useful_positions
+    # Returns a [n_ctx] tensor of the failure counts (as per test_maths_questions_by_impact) and a list of n_ctx answer impact
+    # summaries. e.g. "A543" means ablating the position makes the model get answer digits A5, A4 and/or A3 wrong. "" if there are no failures.
+    if positions is None:
+        positions = list(range(cfg.n_ctx))
 
-            # Only count the question if the model got the question wrong
-            impact_str = get_question_answer_impact(cfg, q, answer_str )
-            if 'A' in impact_str:
-                num_fails += 1
+    all_losses_raw, all_max_prob_tokens = predict_maths_questions_stacked_position_ablation(cfg, acfg, questions, positions, mean_values)
+    num_positions, num_questions, _ = all_max_prob_tokens.shape
 
-                if acfg.show_test_failures:
-                    print(tokens_to_string(cfg, q), "ModelAnswer:", answer_str, "Impact:", impact_str, "Loss:", format(the_loss_mean, ".4f"))
+    # Score all the ablated positions at once
+    failed = get_maths_question_fails(cfg, acfg, questions.repeat(num_positions, 1), all_losses_raw.flatten(0, 1), all_max_prob_tokens.flatten(0, 1)).view(num_positions, num_questions)
+    correct_answers = widen_tokens(questions[:, -cfg.num_answer_positions:]).to(all_max_prob_tokens.device)
+    wrong_answer_digits = ((all_max_prob_tokens != correct_answers) & failed.unsqueeze(2)).any(dim=1).tolist()
+
+    fail_counts = torch.zeros(cfg.n_ctx, dtype=torch.int64, device=failed.device)
+    fail_counts[torch.tensor(positions, device=failed.device)] = failed.sum(dim=1)
+
+    impact_summaries = [""] * cfg.n_ctx
+    for position_num, position in enumerate(positions):
+        # Answer token i is answer digit A(num_answer_positions-1-i) e.g. A7 (the sign) to A0 for 6 digit questions
+        impact_digits = "".join(str(cfg.num_answer_positions - 1 - i) for i, wrong in enumerate(wrong_answer_digits[position_num]) if wrong)
+        if impact_digits != "":
+            impact_summaries[position] = "A" + sort_unique_digits(impact_digits, True)
 
-    return num_fails
+    return fail_counts, impact_summaries
 
 
 def test_maths_questions_and_add_useful_node_tags(cfg, acfg, questions, node_location, all_losses_raw, all_max_prob_tokens):
@@ -114,6 +156,7 @@ def test_maths_questions_and_add_useful_node_tags(cfg, acfg, questions, node_loc
     add_complexity_fails = ""
     sub_complexity_fails = ""
     neg_complexity_fails = ""
+    mul_complexity_fails = ""
 
     for question_num in range(questions.shape[0]):
         q = questions[question_num]
@@ -138,6 +181,8 @@ def test_maths_questions_and_add_useful_node_tags(cfg, acfg, questions, node_loc
                     sub_complexity_fails += minor_tag.value
                 elif major_tag == QType.MATH_NEG:
                     neg_complexity_fails += minor_tag.value
+                elif major_tag == QType.MATH:
+                    mul_complexity_fails += minor_tag.value
 
                 if acfg.show_test_failures :
                     print(tokens_to_string(cfg, q), "U: ModelAnswer:", answer_str, "Complexity:", major_tag, "Impact:", impact_str, "Loss:", the_loss_mean )
@@ -161,8 +206,12 @@ def test_maths_questions_and_add_useful_node_tags(cfg, acfg, questions, node_loc
         if neg_complexity_fails != "":
             cfg.add_useful_node_tag( node_location, QType.MATH_NEG.value, MathsBehavior.NEG_COMPLEXITY_PREFIX.value + sort_unique_digits(neg_complexity_fails, False) )
 
+        # Add summary of all multiplication question complexity quanta failures
+        if mul_complexity_fails != "":
+            cfg.add_useful_node_tag( node_location, QType.MATH.value, MathsBehavior.MUL_COMPLEXITY_PREFIX.value + sort_unique_digits(mul_complexity_fails, False) )
 
-def test_correctness_on_num_questions(cfg, acfg, num_questions=1000000, enrich_data=True):
+
+def test_correctness_on_num_questions(cfg, acfg, num_questions=1000000, enrich_data=True, target_nines=None, confidence=0.95, state_file_prefix=None, failure_corpus=None):
     store_perc_sub = cfg.perc_sub
     store_perc_mult = cfg.perc_mult
 
@@ -172,46 +221,75 @@ def test_correctness_on_num_questions(cfg, acfg, num_questions=1000000, enrich_d
     print_config()
     print()
 
+    # If state_file_prefix is given, each operation's progress is checkpointed to its own state file (so an interrupted run can be resumed)
+    def state_file(operation):
+        return None if state_file_prefix is None else f"{state_file_prefix}_{operation}.json"
+
+    # If failure_corpus is given, each operation's failures go to their own corpus file (e.g. fails.bin gives fails_add.bin and fails_sub.bin)
+    # so resuming one operation (which truncates its corpus to the last checkpoint) never touches the other operation's failures
+    def failure_corpus_file(operation):
+        if failure_corpus is None:
+            return None
+        root, extension = os.path.splitext(failure_corpus)
+        return f"{root}_{operation}{extension}"
+
     if cfg.perc_add > 0:
         print("Addition:")
         cfg.perc_sub = 0
         cfg.perc_mult = 0
-        test_correctness_on_num_questions_core(cfg, acfg, num_questions=num_questions, enrich_data=enrich_data)
+        test_correctness_on_num_questions_core(cfg, acfg, num_questions=num_questions, enrich_data=enrich_data, target_nines=target_nines, confidence=confidence, state_file=state_file("add"), failure_corpus=failure_corpus_file("add"))
 
     if store_perc_sub > 0:
         print("Subtraction:")
         cfg.perc_sub = 100
         cfg.perc_mult = 0
-        test_correctness_on_num_questions_core(cfg, acfg, num_questions=num_questions, enrich_data=enrich_data)
+        test_correctness_on_num_questions_core(cfg, acfg, num_questions=num_questions, enrich_data=enrich_data, target_nines=target_nines, confidence=confidence, state_file=state_file("sub"), failure_corpus=failure_corpus_file("sub"))
         print()
 
     cfg.perc_sub = store_perc_sub
     cfg.perc_mult = store_perc_mult
 
 
-def test_correctness_on_num_questions_core(cfg, acfg, num_questions=1000000, enrich_data=True):
-    old_seed = cfg.analysis_seed
+def get_nines_check_num(num_batches_tested, is_last_batch=False):
+    # The nines decision (refer get_nines_decision) is only checked after 1, 2, 4, 8, ... batches, and after the last batch.
+    # Returns the (1-based) check number after num_batches_tested batches, or None if there is no check then.
+    # Each check number is used at most once in a run, so the confidence can be split across the checks.
+    if num_batches_tested & (num_batches_tested - 1) == 0:
+        return num_batches_tested.bit_length()
+    if is_last_batch:
+        return num_batches_tested.bit_length() + 1
+    return None
 
-    # Create a local data generator
-    cfg.analysis_seed = 345621  # Randomly chosen
-    assert( cfg.analysis_seed != cfg.training_seed ) # Must be ifferent from training
-    local_ds = maths_data_generator(cfg=cfg, enrich_data=enrich_data)  
 
-    the_successes = 0
-    the_fails = 0
+def get_nines_check_confidence(confidence, check_num):
+    # The confidence used at check check_num. Check k spends (1 - confidence) / (k * (k+1)) of the error budget. These sum to
+    # (1 - confidence) over all checks, so however many checks are made the overall error rate is at most 1 - confidence.
+    return 1 - (1 - confidence) / (check_num * (check_num + 1))
 
-    num_batches = 1 + ( num_questions//cfg.batch_size )
-    for epoch in tqdm(range(num_batches)):
-        tokens = next(local_ds)
 
-        the_fails += test_maths_questions_by_impact(cfg, acfg, tokens, 0, False)
+def get_nines_fail_budget(num_questions, target_nines):
+    # The most fails num_questions can have and still show target_nines 9s accuracy (e.g. 100 fails in 1M questions for four 9s)
+    return num_questions * 10.0 ** -target_nines
 
-        the_successes = the_successes + cfg.batch_size
 
-        if epoch % 100 == 0:
-            print("Batch", epoch, "of", num_batches, "#Successes=", the_successes, "#Fails=", the_fails)
+def get_nines_decision(num_fails, num_tested, num_questions, target_nines, confidence=0.95, check_num=None):
+    # Sequential test of the claim "Model has target_nines 9s accuracy" (a failure rate of at most 10^-target_nines) part way through
+    # a test of num_questions. The claim is ruled out when the fail budget for num_questions (as used by test_correctness_on_num_questions_core)
+    # is exceeded, or the lower confidence bound on the failure rate is above the target rate. It is confirmed when the upper bound is below it.
+    # When the decision is checked repeatedly, pass the check number (refer get_nines_check_num) so the bounds are widened to keep the overall
+    # confidence (refer get_nines_check_confidence). Checking after every batch without this confirms a borderline model far too often.
+    # Returns 1 (confirmed), -1 (ruled out) or 0 (undecided) and the adjusted failure rate confidence bounds reached.
+    target_rate = 10.0 ** -target_nines
+    check_confidence = confidence if check_num is None else get_nines_check_confidence(confidence, check_num)
+    low, high = wilson_interval(num_fails, num_tested, check_confidence)
+    if num_fails > get_nines_fail_budget(num_questions, target_nines) or low > target_rate:
+        return -1, low, high
+    if high < target_rate:
+        return 1, low, high
+    return 0, low, high
 
-    print("successes", the_successes, "num_fails", the_fails)
+
+def print_nines_accuracy(num_questions, the_fails):
     if num_questions == 1000000:
         if the_fails <= 1:
             print("Model has six 9s accuracy") # 99.9999%
@@ -223,5 +301,360 @@ def test_correctness_on_num_questions_core(cfg, acfg, num_questions=1000000, enr
             print("Model has three 9s accuracy") # 99.9%
         elif the_fails <= 10000:
             print("Model has two 9s accuracy") # 99%
+
+
+# Keys of a correctness run state that identify the question stream. States can only be resumed or merged if these match.
+CORRECTNESS_STATE_KEYS = ['n_digits', 'perc_sub', 'perc_mult', 'batch_size', 'seed', 'enrich_data', 'num_questions']
+
+
+# Save a correctness run state (refer test_correctness_on_num_questions_core) to a small json file.
+# Writes to a temporary file then renames it, so an interruption while saving does not corrupt the previous state.
+def save_correctness_state(state_file, state):
+    temp_file = state_file + ".tmp"
+    with open(temp_file, 'w') as f:
+        json.dump(state, f)
+    os.replace(temp_file, state_file)
+
+
+def load_correctness_state(state_file):
+    with open(state_file, 'r') as f:
+        return json.load(f)
+
+
+def test_correctness_on_num_questions_core(cfg, acfg, num_questions=1000000, enrich_data=True, target_nines=None, confidence=0.95,
+        state_file=None, start_batch=0, stop_batch=None, checkpoint_batches=100, failure_corpus=None):
+    # If target_nines (e.g. 4 for 99.99% accuracy) is given, the test stops early as soon as that accuracy is statistically
+    # confirmed or ruled out (refer get_nines_decision), rather than always testing num_questions. The decision is checked after
+    # 1, 2, 4, 8, ... batches (refer get_nines_check_num), with confidence split across the checks so confidence holds for the whole run.
+    # Exceeding the fail budget (refer get_nines_fail_budget) rules the accuracy out straight away, so is checked after every batch.
+    # If state_file is given, progress (next batch index, counts and failing questions) is saved every checkpoint_batches batches.
+    # If the state_file already exists, the run resumes from where it left off. If it already stopped early on target_nines, that decision is
+    # reported again and no more batches are tested. Batches start_batch to stop_batch-1 (default all) are tested, so a large test can be
+    # split into batch ranges run as separate jobs and then merged (refer merge_correctness_states).
+    # If failure_corpus is given, the failing questions, model answers, losses and complexity codes are appended to that
+    # failure corpus file (refer load_maths_failure_corpus) so the hard cases can be re-tested later without another full run.
+    # A new run (with no state to resume) starts a new corpus, so each run (or batch range job) needs its own corpus file.
+    old_seed = cfg.analysis_seed
+
+    # Create a local data generator
+    cfg.analysis_seed = 345621  # Randomly chosen
+    assert( cfg.analysis_seed != cfg.training_seed ) # Must be ifferent from training
+
+    num_batches = 1 + ( num_questions//cfg.batch_size )
+    if stop_batch is None:
+        stop_batch = num_batches
+
+    state = {'n_digits': cfg.n_digits, 'perc_sub': cfg.perc_sub, 'perc_mult': cfg.perc_mult, 'batch_size': cfg.batch_size,
+        'seed': cfg.analysis_seed, 'enrich_data': enrich_data, 'num_questions': num_questions,
+        'start_batch': start_batch, 'stop_batch': stop_batch, 'next_batch': start_batch, 'the_successes': 0, 'the_fails': 0, 'failures': [],
+        'target_nines': target_nines, 'confidence': confidence, 'decision': 0, 'check_num': None, 'low': None, 'high': None}
+    if state_file is not None and os.path.exists(state_file):
+        saved_state = load_correctness_state(state_file)
+        for key in CORRECTNESS_STATE_KEYS + ['start_batch', 'stop_batch']:
+            assert saved_state[key] == state[key], f"State file {state_file} {key} {saved_state[key]} does not match {state[key]}"
+        if saved_state.get('decision', 0) != 0:
+            for key in ['target_nines', 'confidence']:
+                assert saved_state[key] == state[key], f"State file {state_file} was decided with {key} {saved_state[key]}, not {state[key]}"
+        state = saved_state
+        if failure_corpus is not None and os.path.exists(failure_corpus):
+            # Drop any failures appended after the last checkpoint. They will be found again. Never extend the file
+            os.truncate(failure_corpus, min(state.get('failure_corpus_bytes', 0), os.path.getsize(failure_corpus)))
+        print("Resuming from batch", state['next_batch'], "of", stop_batch, "#Successes=", state['the_successes'], "#Fails=", state['the_fails'])
+    elif failure_corpus is not None and os.path.exists(failure_corpus):
+        # A new run starts a new failure corpus, so failures from an earlier run are not duplicated
+        os.remove(failure_corpus)
+
+    the_successes = state['the_successes']
+    the_fails = state['the_fails']
+
+    # A run that already stopped early (on target_nines) is not tested any further. Its decision is reported again
+    decision = state.get('decision', 0)
+    check_num, low, high = state.get('check_num'), state.get('low'), state.get('high')
+    next_batch = stop_batch if decision != 0 else state['next_batch']
+
+    # Batches come from the counter-based question stream for cfg.analysis_seed, so any batch can be replayed exactly. The stream is generated
+    # on the CPU, so runs resumed or merged across CPU and GPU machines test the same questions.
+    # Batches are generated on a background thread while the model evaluates the previous batch
+    local_ds = MathsDataPrefetcher(maths_data_generator_indexed(cfg=cfg, seed=cfg.analysis_seed, enrich_data=enrich_data, start_index=next_batch, stop_index=stop_batch, on_cpu=True))
+
+    # The model evaluates several batches at once (up to the evaluation batch size, refer get_maths_eval_batch_size).
+    # Results are still counted, checkpointed and checked for early stopping batch by batch.
+    batches_per_eval = max(1, get_maths_eval_batch_size(cfg) // cfg.batch_size)
+
+    with local_ds:
+        for group_start in tqdm(range(next_batch, stop_batch, batches_per_eval)):
+            group_stop = min(group_start + batches_per_eval, stop_batch)
+            group_tokens = torch.cat([next(local_ds) for _ in range(group_start, group_stop)])
+
+            # Failures are found for the whole group on the device. Only the per-batch failure counts are synced
+            group_failed, group_losses_raw, group_max_prob_tokens = predict_maths_question_fails(cfg, acfg, group_tokens)
+            group_fails = group_failed.view(-1, cfg.batch_size).sum(dim=1).tolist()
+
+            for epoch in range(group_start, group_stop):
+                batch_rows = slice((epoch - group_start) * cfg.batch_size, (epoch - group_start + 1) * cfg.batch_size)
+                batch_fails = group_fails[epoch - group_start]
+                the_fails += batch_fails
+                if batch_fails > 0:
+                    tokens = group_tokens[batch_rows]
+                    failed = group_failed[batch_rows]
+                    if state_file is not None:
+                        state['failures'] += widen_tokens(tokens[failed.to(tokens.device)]).tolist()
+                    if failure_corpus is not None:
+                        append_maths_failure_corpus(cfg, failure_corpus, tokens[failed.to(tokens.device)], group_max_prob_tokens[batch_rows][failed], group_losses_raw[batch_rows][failed])
+
+                the_successes = the_successes + cfg.batch_size
+
+                if epoch % 100 == 0:
+                    print("Batch", epoch, "of", num_batches, "#Successes=", the_successes, "#Fails=", the_fails)
+
+                if target_nines is not None:
+                    check_num = get_nines_check_num(epoch + 1 - start_batch, epoch + 1 == stop_batch)
+                    if check_num is not None:
+                        decision, low, high = get_nines_decision(the_fails, the_successes, num_questions, target_nines, confidence, check_num)
+                    elif the_fails > get_nines_fail_budget(num_questions, target_nines):
+                        # The fail budget is a fixed count (not an estimate) so it is checked after every batch, with no confidence adjustment
+                        decision = -1
+
+                if state_file is not None and ((epoch + 1 - start_batch) % checkpoint_batches == 0 or epoch + 1 == stop_batch or decision != 0):
+                    state.update({'next_batch': epoch + 1, 'the_successes': the_successes, 'the_fails': the_fails,
+                        'decision': decision, 'check_num': check_num, 'low': low, 'high': high})
+                    if failure_corpus is not None:
+                        state['failure_corpus_bytes'] = os.path.getsize(failure_corpus) if os.path.exists(failure_corpus) else 0
+                    save_correctness_state(state_file, state)
+
+                if decision != 0:
+                    break
+
+            if decision != 0:
+                break
+
+    print("successes", the_successes, "num_fails", the_fails)
+    if decision < 0 and the_fails > get_nines_fail_budget(num_questions, target_nines):
+        print(f"Model does not have {target_nines} 9s accuracy. Ruled out after {the_successes} questions: {the_fails} fails exceeds the fail budget of {get_nines_fail_budget(num_questions, target_nines):g} for {num_questions} questions")
+    elif decision > 0:
+        print(f"Model has {target_nines} 9s accuracy. Confirmed after {the_successes} questions at check {check_num}: failure rate <= {high:.2e} ({get_nines_check_confidence(confidence, check_num):.4%} check confidence, {confidence:.0%} overall)")
+    elif decision < 0:
+        print(f"Model does not have {target_nines} 9s accuracy. Ruled out after {the_successes} questions at check {check_num}: failure rate >= {low:.2e} ({get_nines_check_confidence(confidence, check_num):.4%} check confidence, {confidence:.0%} overall)")
+    elif start_batch == 0 and stop_batch == num_batches:
+        print_nines_accuracy(num_questions, the_fails)
             
-    cfg.analysis_seed = old_seed
\ No newline at end of file
+    cfg.analysis_seed = old_seed
+
+    return the_successes, the_fails
+
+
+def merge_correctness_states(state_files):
+    # Merge the state files of correctness runs over separate batch ranges of the same question stream
+    # (refer test_correctness_on_num_questions_core start_batch and stop_batch). The batch ranges must not overlap.
+    # Returns the merged state. If the merged ranges cover all the questions, prints the model accuracy.
+    states = sorted([load_correctness_state(state_file) for state_file in state_files], key=lambda state: state['start_batch'])
+
+    merged = {key: states[0][key] for key in CORRECTNESS_STATE_KEYS}
+    merged.update({'ranges': [], 'the_successes': 0, 'the_fails': 0, 'failures': []})
+    for state in states:
+        for key in CORRECTNESS_STATE_KEYS:
+            assert state[key] == merged[key], f"Cannot merge states with different {key}: {state[key]} and {merged[key]}"
+        if merged['ranges']:
+            assert state['start_batch'] >= merged['ranges'][-1][1], "Cannot merge states with overlapping batch ranges"
+        merged['ranges'].append([state['start_batch'], state['next_batch']])
+        merged['the_successes'] += state['the_successes']
+        merged['the_fails'] += state['the_fails']
+        merged['failures'] += state['failures']
+
+    print("successes", merged['the_successes'], "num_fails", merged['the_fails'], "batch ranges", merged['ranges'])
+    num_batches = 1 + ( merged['num_questions']//merged['batch_size'] )
+    covered = sum(stop - start for start, stop in merged['ranges'])
+    if covered == num_batches:
+        print_nines_accuracy(merged['num_questions'], merged['the_fails'])
+    else:
+        print("Merged states cover", covered, "of", num_batches, "batches")
+
+    return merged
+
+
+def test_correctness_exhaustive(cfg, acfg, chunk_size=None, max_n_digits=4):
+    # Test the model on every possible question (all first and second operand pairs) for each operation the model was trained on.
+    # Proves the accuracy (rather than estimating it from a random sample) but there are up to 10^(2*n_digits) questions per operation,
+    # so this is only practical for small n_digits (up to about 4). Larger models can be tested by explicitly raising max_n_digits.
+    # Questions are scored and grouped by complexity in whole-tensor operations.
+    # Returns a dictionary of (major_tag, minor_tag) to (num_questions, num_fails).
+    assert cfg.n_digits <= max_n_digits, f"Exhaustive testing of {cfg.n_digits} digit questions is only practical if max_n_digits is raised explicitly"
+
+    operators = []
+    if cfg.perc_add > 0:
+        operators.append(MathsToken.PLUS)
+    if cfg.perc_sub > 0:
+        operators.append(MathsToken.MINUS)
+    if cfg.perc_mult > 0:
+        operators.append(MathsToken.MULT)
+
+    question_counts = None
+    fail_counts = None
+
+    if chunk_size is None:
+        chunk_size = get_maths_eval_batch_size(cfg)
+
+    for operator in operators:
+        print("Testing all", maths_exhaustive_num_questions(cfg, operator), maths_tokens_to_names[operator], "questions")
+
+        with MathsDataPrefetcher(maths_data_generator_exhaustive(cfg, operator, chunk_size)) as local_ds:
+            for questions in local_ds:
+                _, all_max_prob_tokens = predict_maths_questions(cfg, questions, batch_size=chunk_size)
+                model_questions = widen_tokens(questions).to(all_max_prob_tokens.device)
+
+                # A question fails if any answer token is wrong
+                failed = torch.any(all_max_prob_tokens != model_questions[:, -cfg.num_answer_positions:], dim=1)
+                codes = get_maths_complexity_codes(cfg, model_questions)
+
+                chunk_question_counts = torch.bincount(codes, minlength=NUM_MATHS_COMPLEXITY_CODES)
+                chunk_fail_counts = torch.bincount(codes[failed], minlength=NUM_MATHS_COMPLEXITY_CODES)
+                question_counts = chunk_question_counts if question_counts is None else question_counts + chunk_question_counts
+                fail_counts = chunk_fail_counts if fail_counts is None else fail_counts + chunk_fail_counts
+
+                if acfg.show_test_failures:
+                    for question_num in torch.nonzero(failed).flatten().tolist():
+                        print("Failed: Q&A:", tokens_to_string(cfg, model_questions[question_num]), "ModelAnswer:", tokens_to_string(cfg, all_max_prob_tokens[question_num]))
+
+    results = {}
+    total_questions = 0
+    total_fails = 0
+    for code, (num_questions, num_fails) in enumerate(zip(question_counts.tolist(), fail_counts.tolist())):
+        if num_questions > 0:
+            major_tag, minor_tag = maths_complexity_code_to_tags(code)
+            results[(major_tag, minor_tag)] = (num_questions, num_fails)
+            print(f"Group {major_tag.value}.{minor_tag.value}: {num_fails} fails of {num_questions} questions")
+            total_questions += num_questions
+            total_fails += num_fails
+
+    if total_fails == 0:
+        print("Model answers all", total_questions, "questions correctly") # 100% accuracy (proven)
+    else:
+        print("Model fails", total_fails, "of all", total_questions, "questions")
+
+    return results
+
+
+def test_correctness_of_models_worker(cfg, acfg, models, model_nums, batch_queue, result_queue):
+    # Worker process for test_correctness_of_models. Tests its share of the models on each question batch from batch_queue
+    # (until None is received) then puts the models' per-complexity-code fail counts on result_queue.
+    fail_counts = torch.zeros((len(models), NUM_MATHS_COMPLEXITY_CODES), dtype=torch.int64)
+    while True:
+        item = batch_queue.get()
+        if item is None:
+            break
+
+        questions, codes = item
+        questions = questions.to(cfg.data_device)
+        for model_index, model in enumerate(models):
+            cfg.main_model = model
+            failed, _, _ = predict_maths_question_fails(cfg, acfg, questions)
+            fail_counts[model_index] += torch.bincount(codes[failed.cpu()], minlength=NUM_MATHS_COMPLEXITY_CODES)
+
+    result_queue.put((model_nums, fail_counts))
+
+
+def test_correctness_of_models(cfg, acfg, models, model_names=None, num_questions=1000000, enrich_data=True, question_batches=None, num_workers=0):
+    # Test the correctness of several models (e.g. checkpoints, seeds or insert variants of one model) on the same questions.
+    # Each question batch is generated once (as a mix of the cfg operations) or loaded from question_batches (e.g. a MmapMathsDataset),
+    # and is run through all the models. If num_workers > 0, the models are shared between that many worker processes which
+    # evaluate each batch in parallel. The models must then be picklable. If a worker dies, the other workers are stopped and a RuntimeError is raised.
+    # Prints the per-model and per-complexity fails side by side.
+    # Returns a dictionary of model name to a dictionary of (major_tag, minor_tag) to (num_questions, num_fails), as per test_correctness_exhaustive.
+    if model_names is None:
+        model_names = ["Model" + str(model_num) for model_num in range(len(models))]
+    assert len(model_names) == len(models)
+
+    old_seed = cfg.analysis_seed
+    old_model = getattr(cfg, 'main_model', None)
+    cfg.analysis_seed = 345621 # Same seed as test_correctness_on_num_questions_core. The batches mix the operations, so the questions differ from its per-operation runs
+    assert( cfg.analysis_seed != cfg.training_seed ) # Must be different from training
+
+    generate_questions = question_batches is None
+    if generate_questions:
+        num_batches = 1 + ( num_questions//cfg.batch_size )
+        question_batches = maths_data_generator_indexed(cfg=cfg, seed=cfg.analysis_seed, enrich_data=enrich_data, stop_index=num_batches, mixed=True, on_cpu=True)
+
+    question_counts = torch.zeros(NUM_MATHS_COMPLEXITY_CODES, dtype=torch.int64)
+    fail_counts = torch.zeros((len(models), NUM_MATHS_COMPLEXITY_CODES), dtype=torch.int64)
+
+    if num_workers > 0:
+        # Each worker holds a share of the models. Batches are passed to the workers in shared memory (not copied)
+        worker_cfg = copy.copy(cfg)
+        worker_cfg.main_model = None
+        worker_acfg = types.SimpleNamespace(threshold=acfg.threshold, show_test_failures=False)
+        context = torch.multiprocessing.get_context("spawn")
+        batch_queues = [context.Queue(maxsize=4) for _ in range(num_workers)]
+        result_queue = context.Queue()
+        workers = []
+        for worker_num in range(num_workers):
+            model_nums = list(range(worker_num, len(models), num_workers))
+            worker = context.Process(target=test_correctness_of_models_worker,
+                args=(worker_cfg, worker_acfg, [models[model_num] for model_num in model_nums], model_nums, batch_queues[worker_num], result_queue))
+            worker.start()
+            workers.append(worker)
+
+        def check_workers():
+            # A worker that has died (e.g. from an exception or running out of memory) will never take another batch or send its results
+            for worker in workers:
+                if worker.exitcode not in (None, 0):
+                    for other_worker in workers:
+                        other_worker.terminate()
+                    raise RuntimeError(f"test_correctness_of_models worker {worker.name} died with exit code {worker.exitcode}")
+
+        def put_batch(batch_queue, item):
+            while True:
+                try:
+                    batch_queue.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    check_workers()
+
+    with MathsDataPrefetcher(question_batches) as local_ds:
+        for questions in tqdm(local_ds):
+            codes = get_maths_complexity_codes(cfg, questions)
+            question_counts += torch.bincount(codes, minlength=NUM_MATHS_COMPLEXITY_CODES).cpu()
+
+            if num_workers > 0:
+                shared_batch = (questions.cpu().share_memory_(), codes.cpu().share_memory_())
+                for batch_queue in batch_queues:
+                    put_batch(batch_queue, shared_batch)
+            else:
+                for model_num, model in enumerate(models):
+                    cfg.main_model = model
+                    failed, _, _ = predict_maths_question_fails(cfg, acfg, questions)
+                    fail_counts[model_num] += torch.bincount(codes[failed.to(codes.device)], minlength=NUM_MATHS_COMPLEXITY_CODES).cpu()
+
+    if num_workers > 0:
+        for batch_queue in batch_queues:
+            put_batch(batch_queue, None)
+        for _ in workers:
+            while True:
+                try:
+                    model_nums, worker_fail_counts = result_queue.get(timeout=1)
+                    break
+                except queue.Empty:
+                    check_workers()
+            fail_counts[model_nums] = worker_fail_counts
+        for worker in workers:
+            worker.join()
+
+    cfg.analysis_seed = old_seed
+    cfg.main_model = old_model
+
+    # Print the fails per complexity group (rows) for each model (columns)
+    print(f"{'Group':>12} {'Questions':>10}" + "".join(f" {model_name:>12}" for model_name in model_names))
+    results = {model_name: {} for model_name in model_names}
+    for code in torch.nonzero(question_counts).flatten().tolist():
+        major_tag, minor_tag = maths_complexity_code_to_tags(code)
+        print(f"{major_tag.value + '.' + minor_tag.value:>12} {int(question_counts[code]):>10}" + "".join(f" {int(fail_counts[model_num, code]):>12}" for model_num in range(len(models))))
+        for model_num, model_name in enumerate(model_names):
+            results[model_name][(major_tag, minor_tag)] = (int(question_counts[code]), int(fail_counts[model_num, code]))
+    total_questions = int(question_counts.sum())
+    print(f"{'Total':>12} {total_questions:>10}" + "".join(f" {int(fail_counts[model_num].sum()):>12}" for model_num in range(len(models))))
+
+    for model_num, model_name in enumerate(model_names):
+        print(model_name + ":", "successes", total_questions, "num_fails", int(fail_counts[model_num].sum()))
+        if generate_questions:
+            print_nines_accuracy(num_questions, int(fail_counts[model_num].sum()))
+
+    return results
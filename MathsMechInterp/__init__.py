@@ -1,7 +1,17 @@
 from MathsMechInterp.maths_config import MathsConfig
 from MathsMechInterp.maths_constants import MathsBehavior, MathsToken, MathsTask, maths_tokens_to_names, maths_tokens_to_names
-from MathsMechInterp.maths_utilities import set_maths_vocabulary, set_maths_question_meanings, int_to_answer_str, tokens_to_unsigned_int, tokens_to_answer
-from MathsMechInterp.maths_data_generator import maths_data_generator_addition, maths_data_generator_subtraction, maths_data_generator_multiplication, maths_data_generator, maths_data_generator_mixed, make_maths_questions_and_answers, MixedMathsDataset, get_mixed_maths_dataloader
+from MathsMechInterp.maths_utilities import set_maths_vocabulary, set_maths_question_meanings, int_to_answer_str, tokens_to_unsigned_int, tokens_to_answer, answers_to_tokens, widen_tokens, ints_to_digits, digits_to_ints
+from MathsMechInterp.maths_data_generator import (maths_data_generator_addition, maths_data_generator_subtraction, maths_data_generator_multiplication, maths_data_generator, maths_data_generator_mixed, make_maths_questions_and_answers, MixedMathsDataset, get_mixed_maths_dataloader,
+    MathsDataPrefetcher, maths_data_generator_prefetch, maths_data_generator_mixed_prefetch,
+    make_batch_rng, maths_data_generator_core, maths_data_generator_batch_at, maths_data_generator_indexed, maths_data_generator_exhaustive, maths_operand_limit, maths_exhaustive_num_questions)
+from MathsMechInterp.maths_data_stratified import maths_data_generator_stratified, maths_data_generator_stratified_core, ADD_STRATIFIED_TAGS, SUB_STRATIFIED_TAGS, NEG_STRATIFIED_TAGS
+from MathsMechInterp.maths_data_profile import profile_maths_data_generator, wilson_interval
+from MathsMechInterp.maths_data_store import (write_maths_data_store, read_maths_data_store_header, MmapMathsDataset, get_mmap_maths_dataloader,
+    write_maths_file_header, read_maths_file_header, map_maths_file)
+from MathsMechInterp.maths_failure_corpus import append_maths_failure_corpus, read_maths_failure_corpus_header, load_maths_failure_corpus, split_maths_failure_corpus
+from MathsMechInterp.maths_evaluation import predict_maths_questions, probe_maths_eval_batch_size, get_maths_eval_batch_size
+from MathsMechInterp.maths_ablation import (get_maths_node_mean_values, get_maths_ablation_node_locations, get_maths_stacked_ablation_hooks, 
+    predict_maths_questions_stacked_ablation, ablate_nodes_and_add_useful_node_tags, get_maths_stacked_position_ablation_hooks, predict_maths_questions_stacked_position_ablation)
 from MathsMechInterp.maths_search_add import add_ss_functions, add_sc_functions, add_sa_functions, add_st_functions
 from MathsMechInterp.maths_search_sub import sub_mt_functions, sub_gt_functions, sub_mb_functions, sub_md_functions, neg_nd_functions, neg_nb_functions
 from MathsMechInterp.maths_search_mix import run_strong_intervention, run_weak_intervention, SubTaskBaseMath, opr_functions, sgn_functions
@@ -10,10 +20,13 @@ from MathsMechInterp.maths_pca import _build_title_and_error_message, pca_op_tag
 from MathsMechInterp.MathsTestQuestions.tricase_test_questions_generator import (
     TOTAL_TRICASE_QUESTIONS, make_maths_tricase_questions, make_maths_tricase_questions_customized)
 from MathsMechInterp.MathsTestQuestions.manual_test_questions_generator import make_maths_test_questions_and_answers
-from MathsMechInterp.MathsTestQuestions.test_questions_checker import (test_maths_questions_by_complexity, test_maths_questions_by_impact, 
-    test_maths_questions_and_add_useful_node_tags, test_correctness_on_num_questions, test_correctness_on_num_questions_core)
+from MathsMechInterp.MathsTestQuestions.test_questions_checker import (test_maths_questions_by_complexity, test_maths_questions_by_impact, test_maths_questions_by_impact_sweep, get_maths_question_fails, 
+    test_maths_questions_and_add_useful_node_tags, test_correctness_on_num_questions, test_correctness_on_num_questions_core, test_correctness_exhaustive, test_correctness_of_models, get_nines_decision, get_nines_fail_budget, get_nines_check_num, get_nines_check_confidence, 
+    predict_maths_question_fails, merge_correctness_states, save_correctness_state, load_correctness_state)
 
-from MathsMechInterp.maths_complexity import (SimpleQuestionDescriptor, get_maths_min_complexity, get_maths_question_complexity, 
+from MathsMechInterp.maths_complexity import (SimpleQuestionDescriptor, QuestionBatch, get_maths_min_complexity, get_maths_question_complexity, 
+    get_maths_question_complexity_batch, MATHS_COMPLEXITY_MAJOR_TAGS, MATHS_COMPLEXITY_MINOR_TAGS, 
+    get_maths_complexity_codes, maths_complexity_code_to_tags, NUM_MATHS_COMPLEXITY_CODES, 
     calc_maths_quanta_for_position_nodes, get_maths_node_operation_coverage, get_maths_nodes_operation_coverage, get_maths_operation_complexity)
 
 from MathsMechInterp.model_sae_train import analyze_mlp_with_sae, optimize_sae_hyperparameters
@@ -0,0 +1,145 @@
+import torch
+from QuantaMechInterp import NodeLocation
+from MathsMechInterp.maths_utilities import widen_tokens
+from MathsMechInterp.maths_evaluation import predict_maths_questions_chunk, get_maths_eval_batch_size
+
+
+# Stacked ablation: many nodes (or token positions) are mean-ablated in a single forward pass. The question batch is replicated along
+# a node axis (replica k holds all the questions) and each replica has a different node (attention head or MLP slice at a token position)
+# or position ablated. This gives the same results as ablating each node in its own forward pass, but needs far fewer, far larger, forward passes.
+
+
+# Return the mean (over the questions) attention head outputs (acfg.l_attn_hook_z_name), MLP neuron outputs (acfg.l_mlp_hook_post_name) and
+# residual stream (acfg.l_hook_resid_post_name) at each layer, as a dictionary of hook name to [n_ctx, n_heads, d_head], [n_ctx, d_mlp]
+# or [n_ctx, d_model] tensor. Used as the mean ablation values.
+def get_maths_node_mean_values(cfg, acfg, questions):
+    mean_values = {}
+
+    def store_mean_hook(value, hook):
+        mean_values[hook.name] = value.mean(dim=0)
+
+    hook_names = acfg.l_attn_hook_z_name[:cfg.n_layers] + acfg.l_mlp_hook_post_name[:cfg.n_layers] + acfg.l_hook_resid_post_name[:cfg.n_layers]
+    with torch.inference_mode():
+        cfg.main_model.run_with_hooks(widen_tokens(questions), return_type=None, fwd_hooks=[(name, store_mean_hook) for name in hook_names])
+
+    return mean_values
+
+
+# Return the default sweep of node locations: every attention head and MLP slice in every layer at each of cfg.useful_positions
+def get_maths_ablation_node_locations(cfg):
+    node_locations = []
+    for position in cfg.useful_positions:
+        for layer in range(cfg.n_layers):
+            for head in range(cfg.n_heads):
+                node_locations.append(NodeLocation(position, layer, True, head))
+            for mlp_slice in range(cfg.mlp_slices):
+                node_locations.append(NodeLocation(position, layer, False, mlp_slice))
+    return node_locations
+
+
+# Return the forward hooks that mean-ablate node_locations[k] in the kth replica of a [len(node_locations) * num_questions, n_ctx] stacked batch
+def get_maths_stacked_ablation_hooks(cfg, acfg, node_locations, num_questions, mean_values):
+    num_replicas = len(node_locations)
+    the_hooks = []
+
+    for layer in range(cfg.n_layers):
+        for is_head, hook_name in [(True, acfg.l_attn_hook_z_name[layer]), (False, acfg.l_mlp_hook_post_name[layer])]:
+            replicas = [k for k, node in enumerate(node_locations) if node.layer == layer and node.is_head == is_head]
+            if not replicas:
+                continue
+
+            device = mean_values[hook_name].device
+            replica_index = torch.tensor(replicas, device=device)
+            position_index = torch.tensor([node_locations[k].position for k in replicas], device=device)
+            num_index = torch.tensor([node_locations[k].num for k in replicas], device=device)
+            # For MLP nodes, the [len(replicas), d_mlp] mask of the neurons in each replica's MLP slice
+            d_mlp = mean_values[hook_name].shape[-1]
+            slice_mask = (torch.arange(d_mlp, device=device) // (d_mlp // cfg.mlp_slices)).unsqueeze(0) == num_index.unsqueeze(1)
+
+            def ablate_hook(value, hook, is_head=is_head, replica_index=replica_index, position_index=position_index, num_index=num_index, slice_mask=slice_mask):
+                # View the stacked batch as [num_replicas, num_questions, n_ctx, ...] and overwrite each replica's node with its mean value
+                stacked = value.view(num_replicas, num_questions, *value.shape[1:])
+                mean_value = mean_values[hook.name]
+                if is_head:
+                    stacked[replica_index, :, position_index, num_index] = mean_value[position_index, num_index].unsqueeze(1)
+                else:
+                    current = stacked[replica_index, :, position_index]
+                    stacked[replica_index, :, position_index] = torch.where(slice_mask.unsqueeze(1), mean_value[position_index].unsqueeze(1), current)
+                return value
+
+            the_hooks.append((hook_name, ablate_hook))
+
+    return the_hooks
+
+
+# Return the forward hook that mean-ablates the residual stream (after layer) at positions[k] in the kth replica of a
+# [len(positions) * num_questions, n_ctx] stacked batch. Ablates all nodes at the position (as per acfg.resid_put_hooks)
+def get_maths_stacked_position_ablation_hooks(acfg, positions, num_questions, mean_values, layer=0):
+    hook_name = acfg.l_hook_resid_post_name[layer]
+    device = mean_values[hook_name].device
+    replica_index = torch.arange(len(positions), device=device)
+    position_index = torch.tensor(positions, device=device)
+
+    def ablate_hook(value, hook):
+        stacked = value.view(len(positions), num_questions, *value.shape[1:])
+        stacked[replica_index, :, position_index] = mean_values[hook.name][position_index].unsqueeze(1)
+        return value
+
+    return [(hook_name, ablate_hook)]
+
+
+# Predict the answers to the questions replicated num_replicas times, with get_hooks(start, stop) giving the hooks for replicas start to stop-1.
+# As many replicas as fit in the evaluation batch size (refer get_maths_eval_batch_size) are run in each forward pass.
+# Returns [num_replicas, num_questions, num_answer_positions] all_losses_raw and all_max_prob_tokens tensors.
+def predict_maths_questions_stacked(cfg, questions, num_replicas, get_hooks):
+    num_questions = questions.shape[0]
+    replicas_per_pass = max(1, get_maths_eval_batch_size(cfg) // num_questions)
+    questions = widen_tokens(questions)
+
+    all_losses_raw = []
+    all_max_prob_tokens = []
+    for start in range(0, num_replicas, replicas_per_pass):
+        stop = min(start + replicas_per_pass, num_replicas)
+        pass_losses_raw, pass_max_prob_tokens = predict_maths_questions_chunk(cfg, questions.repeat(stop - start, 1), get_hooks(start, stop))
+        all_losses_raw.append(pass_losses_raw.view(stop - start, num_questions, -1))
+        all_max_prob_tokens.append(pass_max_prob_tokens.view(stop - start, num_questions, -1))
+
+    return torch.cat(all_losses_raw), torch.cat(all_max_prob_tokens)
+
+
+# Predict the answers to the questions with each of node_locations mean-ablated (one node at a time).
+# Returns [num_nodes, num_questions, num_answer_positions] all_losses_raw and all_max_prob_tokens tensors.
+def predict_maths_questions_stacked_ablation(cfg, acfg, questions, node_locations, mean_values=None):
+    if mean_values is None:
+        mean_values = get_maths_node_mean_values(cfg, acfg, questions)
+
+    def get_hooks(start, stop):
+        return get_maths_stacked_ablation_hooks(cfg, acfg, node_locations[start:stop], questions.shape[0], mean_values)
+
+    return predict_maths_questions_stacked(cfg, questions, len(node_locations), get_hooks)
+
+
+# Predict the answers to the questions with each of positions (default all cfg.n_ctx positions) mean-ablated (one position at a time).
+# Returns [num_positions, num_questions, num_answer_positions] all_losses_raw and all_max_prob_tokens tensors.
+def predict_maths_questions_stacked_position_ablation(cfg, acfg, questions, positions=None, mean_values=None):
+    if positions is None:
+        positions = list(range(cfg.n_ctx))
+    if mean_values is None:
+        mean_values = get_maths_node_mean_values(cfg, acfg, questions)
+
+    def get_hooks(start, stop):
+        return get_maths_stacked_position_ablation_hooks(acfg, positions[start:stop], questions.shape[0], mean_values)
+
+    return predict_maths_questions_stacked(cfg, questions, len(positions), get_hooks)
+
+
+# Mean-ablate each of node_locations (default get_maths_ablation_node_locations) and add the useful node tags (refer
+# test_maths_questions_and_add_useful_node_tags) for each node. A stacked alternative to QuantaMechInterp's
+# ablate_head_and_add_useful_node_tags and ablate_mlp_and_add_useful_node_tags that needs only a few forward passes.
+def ablate_nodes_and_add_useful_node_tags(cfg, acfg, questions, test_function, node_locations=None, mean_values=None):
+    if node_locations is None:
+        node_locations = get_maths_ablation_node_locations(cfg)
+
+    all_losses_raw, all_max_prob_tokens = predict_maths_questions_stacked_ablation(cfg, acfg, questions, node_locations, mean_values)
+    for node_num, node_location in enumerate(node_locations):
+        test_function(cfg, acfg, questions, node_location, all_losses_raw[node_num], all_max_prob_tokens[node_num])
@@ -0,0 +1,111 @@
+import torch
+from MathsMechInterp.maths_constants import MathsToken
+
+
+# Calculates answer digits directly from question digit tensors, column by column, using carry/borrow propagation.
+# Unlike folding the digits into int64 values, this works for any number of digits (e.g. 10 to 20 digit models).
+# The loops are over digit columns. Each step is a whole-tensor operation over all the questions in the batch.
+
+
+# Propagate carries (or borrows, for negative column values) through a [B, num_columns] tensor of column values (least significant column first).
+# Returns the [B, num_columns] digits (least significant first) and the [B] final carry (negative for a final borrow).
+def propagate_column_carries( columns ):
+    digits = torch.empty_like(columns)
+    carry = torch.zeros_like(columns[:, 0])
+    for col in range(columns.shape[1]):
+        value = columns[:, col] + carry
+        digits[:, col] = value % 10 # Floor modulus, so a negative value gives a digit and a borrow (carry of -1)
+        carry = value // 10
+    return digits, carry
+
+
+# Add [B, n_digits] digit tensors x and y (most significant digit first).
+# Returns a [B] "answer is negative" tensor (always False) and the [B, n_digits+1] answer digits (least significant first).
+def column_add( x, y ):
+    digits, carry = propagate_column_carries( (x + y).flip(1) )
+    return torch.zeros_like(carry, dtype=torch.bool), torch.cat((digits, carry.unsqueeze(1)), 1)
+
+
+# Subtract [B, n_digits] digit tensor y from x (most significant digit first).
+# Returns a [B] "answer is negative" tensor and the [B, n_digits] answer magnitude digits (least significant first).
+def column_subtract( x, y ):
+    _, carry = propagate_column_carries( (x - y).flip(1) )
+
+    # A final borrow means x < y. For these questions calculate y - x instead
+    negative = carry < 0
+    difference = torch.where(negative.unsqueeze(1), y - x, x - y)
+    digits, _ = propagate_column_carries( difference.flip(1) )
+    return negative, digits
+
+
+# Multiply [B, n_digits] digit tensors x and y (most significant digit first) using long multiplication.
+# Returns a [B] "answer is negative" tensor (always False) and the [B, 2*n_digits] answer digits (least significant first).
+def column_multiply( x, y ):
+    digits, _ = propagate_column_carries( multiply_columns( x, y ) )
+    return torch.zeros(x.shape[0], dtype=torch.bool, device=x.device), digits
+
+
+# Return the [B, 2*n_digits] long multiplication column sums (least significant first) of [B, n_digits] digit tensors x and y
+# (most significant digit first), before any carries are propagated
+def multiply_columns( x, y ):
+    num_questions, n_digits = x.shape
+    x_lsf = x.flip(1)
+    y_lsf = y.flip(1)
+
+    # Sum the partial products x[i] * y[j] into column i + j. Column sums are at most n_digits * 81
+    partial_products = (x_lsf.unsqueeze(2) * y_lsf.unsqueeze(1)).reshape(num_questions, n_digits * n_digits)
+    column_index = (torch.arange(n_digits, device=x.device).unsqueeze(1) + torch.arange(n_digits, device=x.device).unsqueeze(0)).reshape(-1)
+    columns = torch.zeros((num_questions, 2 * n_digits), dtype=partial_products.dtype, device=x.device)
+    columns.index_add_(1, column_index, partial_products)
+    return columns
+
+
+# Return the [B] number of long multiplication columns that generate a carry into the next column, for [B, n_digits]
+# digit tensors x and y (most significant digit first). Used to classify the complexity of multiplication questions.
+def column_multiply_carries( x, y ):
+    columns = multiply_columns( x.to(torch.int64), y.to(torch.int64) )
+    num_carries = torch.zeros_like(columns[:, 0])
+    carry = torch.zeros_like(columns[:, 0])
+    for col in range(columns.shape[1]):
+        carry = (columns[:, col] + carry) // 10
+        num_carries += carry > 0
+    return num_carries
+
+
+# Calculate the answers to the questions "x operator y" where x and y are [B, n_digits] digit tensors (most significant digit first).
+# Returns a [B, n_digits+2] tensor of answer tokens: the sign then the n_digits+1 answer digits (most significant first).
+# Digits beyond n_digits+1 are truncated (as per answers_to_tokens).
+def column_answers_to_tokens( cfg, x, operator, y ):
+    x = x.to(torch.int64)
+    y = y.to(torch.int64)
+
+    if operator == MathsToken.PLUS:
+        negative, digits = column_add( x, y )
+    elif operator == MathsToken.MINUS:
+        negative, digits = column_subtract( x, y )
+    elif operator == MathsToken.MULT:
+        negative, digits = column_multiply( x, y )
+    else:
+        assert False, f"Unsupported operator {operator}"
+
+    answer_digits = cfg.n_digits + 1
+    tokens = torch.zeros((x.shape[0], answer_digits + 1), dtype=torch.int64, device=x.device)
+    tokens[:, 0] = torch.where(negative, MathsToken.MINUS, MathsToken.PLUS)
+
+    num_digits = min(answer_digits, digits.shape[1])
+    tokens[:, answer_digits + 1 - num_digits:] = digits[:, :num_digits].flip(1)
+
+    return tokens
+
+
+# Given [B, num_columns] "generate" (e.g. MakeCarry1 or BorrowOne) and "propagate" (e.g. MakeSum9 or MakeZero) column masks (least
+# significant column first), return the [B, num_columns] position of each column within a cascade of propagate columns that directly
+# follows a generate column. Columns not in such a cascade are 0. The maximum over the columns is the longest cascade length.
+def column_cascade_lengths( generate, propagate ):
+    index = torch.arange(generate.shape[1], device=generate.device).expand_as(generate)
+
+    # Run-length of propagate columns: the index of the last non-propagate column at or before each column
+    last_stop = torch.cummax(torch.where(propagate, -1, index), dim=1).values
+    run_follows_generate = (last_stop >= 0) & torch.gather(generate, 1, last_stop.clamp(min=0))
+
+    return torch.where(run_follows_generate, index - last_stop, 0)
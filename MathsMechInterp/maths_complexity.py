@@ -4,7 +4,8 @@ from QuantaMechInterp import (to_numpy, QType, a_run_attention_intervention, NO_
     FilterAnd, FilterHead, FilterPosition, FilterAttention, FilterImpact, FilterContains, QCondition, 
     get_quanta_impact, get_quanta_binary, get_quanta_attention, get_quanta_fail_perc, create_colormap, pale_color, 
     ALGO_SHADES, ATTN_SHADES, MATH_SUB_SHADES, MATH_ADD_SHADES, FAIL_SHADES)
-from MathsMechInterp.maths_utilities import tokens_to_unsigned_int
+from MathsMechInterp.maths_utilities import tokens_to_unsigned_int, widen_tokens, digits_to_ints, ints_to_digits, answers_to_tokens
+from MathsMechInterp.maths_column_arithmetic import column_cascade_lengths, column_multiply_carries
 from MathsMechInterp.maths_constants import MathsToken, MathsBehavior, maths_tokens_to_names
 
 
@@ -23,6 +24,7 @@ class SimpleQuestionDescriptor:
 
     @staticmethod
     def from_tensor(cfg, question: torch.LongTensor):
+        question = widen_tokens(question) # Compact uint8 tokens would overflow in the arithmetic below
         first_value = int(tokens_to_unsigned_int(question, offset=0, digits=cfg.n_digits).item())
         second_value = int(tokens_to_unsigned_int(question, offset=cfg.n_digits + 1, digits=cfg.n_digits).item())
 
@@ -36,8 +38,71 @@ class SimpleQuestionDescriptor:
             first_value=first_value, second_value=second_value, answer=answer, operator=operator, raw_tensor=question)
 
 
-# Analyse and return the question complexity for the Addition (S0 to S4) or Subtraction (M0 to NG) questions
+# Struct-of-arrays equivalent of SimpleQuestionDescriptor for a whole batch of questions. The first values, second values, answers,
+# operators and raw tokens are held as parallel tensors, so large batches can be decoded, filtered and grouped without per-question objects.
+class QuestionBatch:
+    __slots__ = ('first_values', 'second_values', 'answers', 'operators', 'raw_tensors')
+
+    def __init__(self, first_values: torch.LongTensor, second_values: torch.LongTensor, answers: torch.LongTensor, operators: torch.LongTensor, raw_tensors: torch.LongTensor):
+        self.first_values = first_values
+        self.second_values = second_values
+        self.answers = answers
+        self.operators = operators
+        self.raw_tensors = raw_tensors
+
+    def __len__(self):
+        return self.raw_tensors.shape[0]
+
+    # Select questions by boolean mask, index tensor or slice
+    def __getitem__(self, selection):
+        return QuestionBatch(
+            first_values=self.first_values[selection], second_values=self.second_values[selection], answers=self.answers[selection],
+            operators=self.operators[selection], raw_tensors=self.raw_tensors[selection])
+
+    def __str__(self):
+        return f'QuestionBatch(num_questions={len(self)})'
+
+    # Return the SimpleQuestionDescriptor of the i-th question
+    def descriptor(self, i: int):
+        return SimpleQuestionDescriptor(
+            first_value=int(self.first_values[i]), second_value=int(self.second_values[i]), answer=int(self.answers[i]),
+            operator=int(self.operators[i]), raw_tensor=self.raw_tensors[i])
+
+    # Decode a [B, n_ctx] tensor of questions (with answers) in whole-tensor operations
+    @staticmethod
+    def from_tensor(cfg, questions: torch.LongTensor):
+        questions = widen_tokens(questions) # Compact uint8 tokens would overflow in the arithmetic below
+        first_values = digits_to_ints(questions[:, :cfg.n_digits])
+        second_values = digits_to_ints(questions[:, cfg.n_digits + 1:2*cfg.n_digits + 1])
+
+        # Offset of 3 - for operator, sign and equals to sign. n_digits+1 answer digits because we keep an extra one for carries.
+        answers = digits_to_ints(questions[:, 2*cfg.n_digits + 3:])
+        answers = torch.where(questions[:, 2*cfg.n_digits + 2] == MathsToken.MINUS, -answers, answers)
+        return QuestionBatch(
+            first_values=first_values, second_values=second_values, answers=answers, operators=questions[:, cfg.n_digits], raw_tensors=questions)
+
+    # Encode the first values, operators, second values and answers as a [B, n_ctx] tensor of questions in whole-tensor operations
+    def to_tensor(self, cfg):
+        questions = torch.zeros((len(self), cfg.n_ctx), dtype=torch.int64, device=self.first_values.device)
+        questions[:, :cfg.n_digits] = ints_to_digits(self.first_values, cfg.n_digits)
+        questions[:, cfg.n_digits] = self.operators
+        questions[:, cfg.n_digits + 1:2*cfg.n_digits + 1] = ints_to_digits(self.second_values, cfg.n_digits)
+        questions[:, cfg.num_question_positions - 1] = MathsToken.EQUALS
+        questions[:, cfg.num_question_positions:] = answers_to_tokens(cfg, self.answers)
+        return questions.to(cfg.token_dtype)
+
+    # Return the [B] integer major and minor complexity tag codes of the questions (refer get_maths_question_complexity_batch)
+    def get_complexity(self, cfg):
+        return get_maths_question_complexity_batch(cfg, self.raw_tensors)
+
+
+# Multiplication complexity minor tags, indexed by the number of long multiplication columns that generate a carry (capped)
+MUL_COMPLEXITY_TAGS = [MathsBehavior.MUL_P0_TAG, MathsBehavior.MUL_P1_TAG, MathsBehavior.MUL_P2_TAG, MathsBehavior.MUL_P3_TAG, MathsBehavior.MUL_P4_TAG]
+
+
+# Analyse and return the question complexity for the Addition (S0 to S5), Subtraction (M0 to N4) or Multiplication (P0 to P4) questions
 def get_maths_question_complexity(cfg, question):
+    question = widen_tokens(question) # Compact uint8 tokens would overflow in the arithmetic below
     qlist = to_numpy(question)
     inputs = qlist[:cfg.num_question_positions]
     operator = qlist[cfg.n_digits]
@@ -159,11 +224,98 @@ def get_maths_question_complexity(cfg, question):
             return QType.MATH_NEG, MathsBehavior.NEG_N1_TAG
 
 
+    if operator == MathsToken.MULT:
+        # Classify by the number of long multiplication columns that generate a carry
+        num_carries = int(column_multiply_carries( question[:cfg.n_digits].unsqueeze(0), question[cfg.n_digits+1:2*cfg.n_digits+1].unsqueeze(0) )[0])
+        return QType.MATH, MUL_COMPLEXITY_TAGS[min(num_carries, len(MUL_COMPLEXITY_TAGS) - 1)]
+
+
     # Should never get here
     print("get_question_complexity OP? exception", question)
     return QType.UNKNOWN, MathsBehavior.UNKNOWN
 
 
+# Integer codes of the major and minor tags returned by get_maths_question_complexity_batch
+MATHS_COMPLEXITY_MAJOR_TAGS = [QType.UNKNOWN, QType.MATH_ADD, QType.MATH_SUB, QType.MATH_NEG, QType.MATH]
+MATHS_COMPLEXITY_MINOR_TAGS = [MathsBehavior.UNKNOWN,
+    MathsBehavior.ADD_S0_TAG, MathsBehavior.ADD_S1_TAG, MathsBehavior.ADD_S2_TAG, MathsBehavior.ADD_S3_TAG, MathsBehavior.ADD_S4_TAG, MathsBehavior.ADD_S5_TAG,
+    MathsBehavior.SUB_M0_TAG, MathsBehavior.SUB_M1_TAG, MathsBehavior.SUB_M2_TAG, MathsBehavior.SUB_M3_TAG, MathsBehavior.SUB_M4_TAG,
+    MathsBehavior.NEG_N1_TAG, MathsBehavior.NEG_N2_TAG, MathsBehavior.NEG_N3_TAG, MathsBehavior.NEG_N4_TAG,
+    MathsBehavior.MUL_P0_TAG, MathsBehavior.MUL_P1_TAG, MathsBehavior.MUL_P2_TAG, MathsBehavior.MUL_P3_TAG, MathsBehavior.MUL_P4_TAG]
+
+
+# Batched version of get_maths_question_complexity for a [B, n_ctx] tensor of questions. Rather than looping over the questions and digits,
+# the MakeCarry1/MakeSum9 and BorrowOne/MakeZero cascades of all questions are found with whole-tensor run-length operations.
+# Returns [B] integer major and minor tag codes, which are indexes into MATHS_COMPLEXITY_MAJOR_TAGS and MATHS_COMPLEXITY_MINOR_TAGS.
+def get_maths_question_complexity_batch(cfg, questions):
+    questions = widen_tokens(questions) # Compact uint8 tokens would overflow in the arithmetic below
+    n_digits = cfg.n_digits
+    operator = questions[:, n_digits]
+    index = torch.arange(n_digits, device=questions.device)
+
+    # Question digits, least significant digit first (as per mc, ms, bo and mz in get_maths_question_complexity)
+    x = questions[:, :n_digits].flip(1)
+    y = questions[:, n_digits+1:2*n_digits+1].flip(1)
+
+    major = torch.zeros_like(operator)
+    minor = torch.zeros_like(operator)
+
+    # Addition: S0 if no MakeCarry1, else S1 to S5 by the longest MakeCarry1 + MakeSum9 cascade
+    mc = x + y > 9
+    ms = x + y == 9
+    add_cascade = column_cascade_lengths(mc, ms).max(dim=1).values
+    add_minor = torch.where(mc.any(dim=1), MATHS_COMPLEXITY_MINOR_TAGS.index(MathsBehavior.ADD_S1_TAG) + torch.clamp(add_cascade, max=4), MATHS_COMPLEXITY_MINOR_TAGS.index(MathsBehavior.ADD_S0_TAG))
+
+    # Subtraction: the answer is negative if the most significant differing column has a BorrowOne
+    bo = x < y
+    mz = x == y
+    top_differing = torch.where(~mz, index, -1).max(dim=1).values
+    negative = (top_differing >= 0) & torch.gather(bo, 1, top_differing.clamp(min=0).unsqueeze(1)).squeeze(1)
+
+    # Positive-answer subtraction: M0 if no BorrowOne, else M1 to M4 by the longest BorrowOne + MakeZero cascade
+    sub_cascade = column_cascade_lengths(bo, mz).max(dim=1).values
+    sub_minor = torch.where(bo.any(dim=1), MATHS_COMPLEXITY_MINOR_TAGS.index(MathsBehavior.SUB_M1_TAG) + torch.clamp(sub_cascade, max=3), MATHS_COMPLEXITY_MINOR_TAGS.index(MathsBehavior.SUB_M0_TAG))
+
+    # Negative-answer subtraction: N1 to N4 by the longest cascade. MakeZeros are not interesting beyond the max_question_digit
+    max_question_digit = torch.where((x > 0) | (y > 0), index, 0).max(dim=1).values
+    neg_cascade = column_cascade_lengths(bo, mz & (index <= max_question_digit.unsqueeze(1))).max(dim=1).values
+    neg_minor = MATHS_COMPLEXITY_MINOR_TAGS.index(MathsBehavior.NEG_N1_TAG) + torch.clamp(neg_cascade, max=3)
+
+    # Multiplication: P0 to P4 by the number of long multiplication columns that generate a carry
+    is_mult = operator == MathsToken.MULT
+    mul_minor = MATHS_COMPLEXITY_MINOR_TAGS.index(MathsBehavior.MUL_P0_TAG) + torch.clamp(column_multiply_carries(x.flip(1), y.flip(1)), max=4)
+
+    is_add = operator == MathsToken.PLUS
+    is_sub = (operator == MathsToken.MINUS) & ~negative
+    is_neg = (operator == MathsToken.MINUS) & negative
+    major[is_add] = MATHS_COMPLEXITY_MAJOR_TAGS.index(QType.MATH_ADD)
+    major[is_sub] = MATHS_COMPLEXITY_MAJOR_TAGS.index(QType.MATH_SUB)
+    major[is_neg] = MATHS_COMPLEXITY_MAJOR_TAGS.index(QType.MATH_NEG)
+    major[is_mult] = MATHS_COMPLEXITY_MAJOR_TAGS.index(QType.MATH)
+    minor = torch.where(is_add, add_minor, minor)
+    minor = torch.where(is_sub, sub_minor, minor)
+    minor = torch.where(is_neg, neg_minor, minor)
+    minor = torch.where(is_mult, mul_minor, minor)
+
+    return major, minor
+
+
+# Number of distinct combined complexity codes (refer get_maths_complexity_codes)
+NUM_MATHS_COMPLEXITY_CODES = len(MATHS_COMPLEXITY_MAJOR_TAGS) * len(MATHS_COMPLEXITY_MINOR_TAGS)
+
+
+# Return [B] combined major and minor complexity tag codes for a [B, n_ctx] tensor of questions.
+# Questions can then be grouped by complexity with e.g. torch.bincount(codes, minlength=NUM_MATHS_COMPLEXITY_CODES)
+def get_maths_complexity_codes(cfg, questions):
+    major, minor = get_maths_question_complexity_batch(cfg, questions)
+    return major * len(MATHS_COMPLEXITY_MINOR_TAGS) + minor
+
+
+# Return the (major_tag, minor_tag) of a combined complexity code (refer get_maths_complexity_codes)
+def maths_complexity_code_to_tags(code : int):
+    return MATHS_COMPLEXITY_MAJOR_TAGS[code // len(MATHS_COMPLEXITY_MINOR_TAGS)], MATHS_COMPLEXITY_MINOR_TAGS[code % len(MATHS_COMPLEXITY_MINOR_TAGS)]
+
+
 # Analyze the tags associated with node, to show the minimum complexity of mathematical task.
 # That is, what is the simpliest type of question that this node is needed for?
 def get_maths_min_complexity(_, node, major_tag : str, minor_tag : str, num_shades : int):
@@ -245,12 +397,14 @@ def calc_maths_quanta_for_position_nodes(cfg, position):
           
                     
 
-# Return a 0 to 3 letter string representing the mathematical operation(s) that this node is involved in
+# Return a 0 to 4 letter string representing the mathematical operation(s) that this node is involved in.
+# Multiplication complexity tags (P0 to P4+) are stored under the generic QType.MATH major tag.
 def get_maths_node_operation_coverage( node ):
     add_text = node.min_tag_suffix( QType.MATH_ADD.value, MathsBehavior.ADD_COMPLEXITY_PREFIX.value )[:1]
     sub_text = node.min_tag_suffix( QType.MATH_SUB.value, MathsBehavior.SUB_COMPLEXITY_PREFIX.value )[:1]
     neg_text = node.min_tag_suffix( QType.MATH_NEG.value, MathsBehavior.NEG_COMPLEXITY_PREFIX.value )[:1]
-    return add_text + sub_text + neg_text
+    mul_text = node.min_tag_suffix( QType.MATH.value, MathsBehavior.MUL_COMPLEXITY_PREFIX.value )[:1]
+    return add_text + sub_text + neg_text + mul_text
     
 
 
@@ -260,17 +414,19 @@ def get_maths_operation_complexity(_, node, __ : str, ___ : str, ____ : int):
 
     color_index = 0
     if cell_text != "" :
-        color_index = len(cell_text)
+        color_index = min(len(cell_text), 3)
 
     return cell_text, color_index
 
 
 
-# Analyze the tags associated with node, to show which mathematical operations apply
+# Analyze the tags associated with node, to show which mathematical operations apply.
+# num_triple counts the nodes involved in three (or more) operations
 def get_maths_nodes_operation_coverage(nodes):
     num_add = 0
     num_sub = 0
     num_neg = 0
+    num_mul = 0
     num_triple = 0
     num_double = 0
     num_single = 0
@@ -284,15 +440,17 @@ def get_maths_nodes_operation_coverage(nodes):
             num_sub += 1
         if MathsBehavior.NEG_COMPLEXITY_PREFIX.value in cell_text:
             num_neg += 1
+        if MathsBehavior.MUL_COMPLEXITY_PREFIX.value in cell_text:
+            num_mul += 1
     
-        if len(cell_text) == 3:
+        if len(cell_text) >= 3:
             num_triple += 1
         elif len(cell_text) == 2:
             num_double += 1
         elif len(cell_text) == 1:
             num_single += 1
             
-    return num_add, num_sub, num_neg, num_triple, num_double, num_single
+    return num_add, num_sub, num_neg, num_mul, num_triple, num_double, num_single
 
 
 
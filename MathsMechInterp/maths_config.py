@@ -1,4 +1,5 @@
 import re
+import torch
 import transformer_lens.utils as utils
 from transformer_lens import HookedTransformerConfig
 
@@ -27,9 +28,31 @@ class MathsConfig(AlgoConfig):
         # Makes easier how we mix and match tricase data from different qtypes.
         self.customized_tricase_questions_dict = {}
 
+        # Device the data generators build question batches on e.g. "cpu" or "cuda:1".
+        # None means use "cuda" if cfg.use_cuda and CUDA is available, else "cpu"
+        self.data_device_name : str = None
+
+        # Store question tokens compactly as uint8 (the vocabulary has only MathsToken.MAX_INDEX+1 tokens) rather than int64.
+        # Tokens are widened to int64 (refer widen_tokens) only when passed to the model.
+        self.compact_tokens : bool = False
+
         self.configure_acfg_singleton()
       
 
+    @property
+    # Torch device that the data generators build x, y, the enrichment masks and the answers on
+    def data_device(self) -> torch.device:
+        if self.data_device_name is not None:
+            return torch.device(self.data_device_name)
+        return torch.device("cuda" if self.use_cuda and torch.cuda.is_available() else "cpu")
+
+
+    @property
+    # Torch dtype that question tokens are stored as in data generator batches and question banks
+    def token_dtype(self) -> torch.dtype:
+        return torch.uint8 if self.compact_tokens else torch.int64
+
+
     @property
     # percentage of addition questions
     def perc_add(self) -> int:
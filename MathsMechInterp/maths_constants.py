@@ -48,6 +48,15 @@ class MathsBehavior(Enum):
     NEG_N4_TAG = "N4+" # Answer < 0. Has multiple cascades of BorrowOne. Hard. E.g. 1111-2000   
     NEG_PCA_TAG = "NP" # PCA is clustered aligned to the ST8,ST9,ST10 question grouping
 
+    # Minor "maths" tags related to major tag QType.MATH (multiplication):
+    # Multiplication operation "complexity" non-overlapping minor tags, by the number of long multiplication columns that generate a carry
+    MUL_COMPLEXITY_PREFIX = "P"
+    MUL_P0_TAG = "P0"  # Easy. No carries. E.g. 1203*3
+    MUL_P1_TAG = "P1"  # One column generates a carry. E.g. 15*3
+    MUL_P2_TAG = "P2"
+    MUL_P3_TAG = "P3"
+    MUL_P4_TAG = "P4+" # Hard. Four or more columns generate a carry
+
     UNKNOWN = "Unknown"
     
 
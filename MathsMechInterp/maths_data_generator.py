@@ -1,18 +1,49 @@
+import copy
 import random
+import itertools
+import queue
+import threading
+import numpy as np
 import torch
-from torch.utils.data import IterableDataset, DataLoader
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
 from QuantaMechInterp import (QType, a_run_attention_intervention, NO_IMPACT_TAG, SubTaskBase, position_name, answer_name, tokens_to_string,
     FilterAnd, FilterHead, FilterPosition, FilterAttention, FilterImpact, FilterContains, QCondition)
 
 from MathsMechInterp.maths_constants import MathsBehavior, MathsToken
-from MathsMechInterp.maths_complexity import get_maths_question_complexity
-from MathsMechInterp.maths_utilities import make_a_maths_question_and_answer
-
-
-def maths_data_generator_start( cfg ):
-    batch = torch.zeros((cfg.batch_size, cfg.n_ctx)).to(torch.int64)
-    x = torch.randint(0, 10, (cfg.batch_size, cfg.n_digits))
-    y = torch.randint(0, 10, (cfg.batch_size, cfg.n_digits))
+from MathsMechInterp.maths_complexity import get_maths_question_complexity_batch, MATHS_COMPLEXITY_MAJOR_TAGS, MATHS_COMPLEXITY_MINOR_TAGS
+from MathsMechInterp.maths_utilities import ints_to_digits
+from MathsMechInterp.maths_column_arithmetic import column_answers_to_tokens
+
+
+# Return a torch.Generator (on cfg.data_device) keyed on (seed, batch_index).
+# Gives O(1) random access to any batch in a "counter-based" question stream:
+# batch_index can be resumed, sharded across processes or replayed without generating the batches before it.
+# On CUDA devices the torch generator is Philox-based. On the CPU it is a Mersenne Twister seeded by a hash of (seed, batch_index).
+# So the stream for a seed depends on cfg.data_device: generate on the same device (or on_cpu, refer maths_data_generator_batch_at) to replay the same questions.
+def make_batch_rng( cfg, seed, batch_index ):
+    batch_seed = int(np.random.SeedSequence([seed, batch_index]).generate_state(1, np.uint64)[0]) & 0x7FFFFFFFFFFFFFFF
+    rng = torch.Generator(device=cfg.data_device)
+    rng.manual_seed(batch_seed)
+    return rng
+
+
+# Return a random integer in the range [low, high] (inclusive).
+# Uses rng (a torch.Generator) if provided, else the global "random" module state.
+def random_int( low, high, rng=None ):
+    if rng is None:
+        return random.randint(low, high)
+    return int(torch.randint(low, high + 1, (1,), generator=rng, device=rng.device).item())
+
+
+# Create the batch, x and y tensors directly on cfg.data_device (avoiding a host-to-device copy per batch)
+# If batch is provided (e.g. a slice of a larger preallocated batch) the questions are written into it, else a cfg.batch_size batch is created.
+def maths_data_generator_start( cfg, rng=None, batch=None ):
+    device = cfg.data_device
+    if batch is None:
+        batch = torch.zeros((cfg.batch_size, cfg.n_ctx), dtype=cfg.token_dtype, device=device)
+    num_questions = batch.shape[0]
+    x = torch.randint(0, 10, (num_questions, cfg.n_digits), generator=rng, device=device)
+    y = torch.randint(0, 10, (num_questions, cfg.n_digits), generator=rng, device=device)
     return (batch, x, y)
 
 
@@ -21,46 +52,27 @@ def maths_data_generator_mid( cfg, x, batch_op, y, batch ):
     batch[:, cfg.n_digits] = batch_op
     batch[:, 1+cfg.n_digits:1+cfg.n_digits*2] = y
     batch[:, cfg.num_question_positions-1] = MathsToken.EQUALS
-
-    # Convert each row into a 5-digit number
-    x_values = x[:, 0]
-    y_values = y[:, 0]
-    for dn in range(1,cfg.n_digits):
-        x_values = x_values * 10 + x[:, dn]
-        y_values = y_values * 10 + y[:, dn]
         
-    return (batch, x_values, y_values)        
-
-
-def maths_data_generator_end( cfg, answers, batch ):
+    return batch
 
-    # Insert the answers into the batch
-    for i in range(cfg.batch_size):
-        answer = answers[i]
 
-        sign = MathsToken.PLUS
-        if answer < 0:
-            sign = MathsToken.MINUS
-            answer = - answer
+def maths_data_generator_end( cfg, x, batch_op, y, batch ):
 
-        batch[i, cfg.num_question_positions] = sign
-        for j in range(cfg.n_digits+1):
-            batch[i, cfg.n_ctx-j-1] = answer % 10
-            answer = answer // 10
-            if answer == 0:
-                break
+    # Calculate the answer signs and digits directly from the question digits (for any n_digits)
+    # and insert them into the batch for all questions at once
+    batch[:, cfg.num_question_positions:] = column_answers_to_tokens( cfg, x, batch_op, y )
 
     return batch
 
 
 # Generate an (optionally enriched) data batch for 
 # "Addition" batch entries formated as XXXXX+YYYYY=+ZZZZZZ e.g. 550030+800020=+1350050
-def maths_data_generator_addition( cfg, enrich_data=True ):
+def maths_data_generator_addition( cfg, enrich_data=True, rng=None, batch=None ):
 
-    (batch, x, y) = maths_data_generator_start( cfg )
+    (batch, x, y) = maths_data_generator_start( cfg, rng, batch )
 
     # Enrich the question data on 60% of batches to speed up training
-    if enrich_data and (random.randint(1, 5) < 3):
+    if enrich_data and (random_int(1, 5, rng) < 3):
         # Flatten x and y to 1D tensors
         x_flat = x.view(-1)
         y_flat = y.view(-1)
@@ -69,8 +81,8 @@ def maths_data_generator_addition( cfg, enrich_data=True ):
         # Increase the MakeSum9 case frequency
         # UseSum9 also relies on MakeCarry1 (50%) from previous column.
         num_elements_to_modify = int(0.40 * x.numel()) # 40%
-        indices_to_modify = torch.randperm(x_flat.numel())[:num_elements_to_modify]
-        if random.randint(1, 2) == 1:
+        indices_to_modify = torch.randperm(x_flat.numel(), generator=rng, device=x_flat.device)[:num_elements_to_modify]
+        if random_int(1, 2, rng) == 1:
             x_flat[indices_to_modify] = 9 - y_flat[indices_to_modify]
         else:
             y_flat[indices_to_modify] = 9 - x_flat[indices_to_modify]
@@ -79,27 +91,24 @@ def maths_data_generator_addition( cfg, enrich_data=True ):
         x = x_flat.view(x.shape)
         y = y_flat.view(x.shape)
 
-    (batch, x_values, y_values) = maths_data_generator_mid( cfg, x, MathsToken.PLUS, y, batch )
- 
-    # Elementwise operations to give the 1D tensor answers
-    answers = x_values + y_values
+    batch = maths_data_generator_mid( cfg, x, MathsToken.PLUS, y, batch )
 
-    return maths_data_generator_end( cfg, answers, batch )
+    return maths_data_generator_end( cfg, x, MathsToken.PLUS, y, batch )
 
 
 # Generate an (optionally enriched) data batch for  
 # "Subtraction" batch entries formated as XXXXX-YYYYY=-ZZZZZZ e.g. 550030-800020=-0249990, 800020-550030=+0249990
-def maths_data_generator_subtraction( cfg, enrich_data=True ):
+def maths_data_generator_subtraction( cfg, enrich_data=True, rng=None, batch=None ):
 
-    (batch, x, y) = maths_data_generator_start( cfg )
+    (batch, x, y) = maths_data_generator_start( cfg, rng, batch )
 
     # Enrich the question data on 60% of batches to speed up training
-    if enrich_data and (random.randint(1, 5) < 3):
+    if enrich_data and (random_int(1, 5, rng) < 3):
         # Flatten x and y to 1D tensors
         x_flat = x.view(-1)
         y_flat = y.view(-1)
 
-        if random.randint(1, 100) == 1:
+        if random_int(1, 100, rng) == 1:
             # For rare cases like 099111-099111=+0000000 some models predict -0000000. Generate more of these cases
             y_flat = x_flat.clone()
 
@@ -113,19 +122,16 @@ def maths_data_generator_subtraction( cfg, enrich_data=True ):
         x = x_flat.view(x.shape)
         y = y_flat.view(x.shape)
 
-    (batch, x_values, y_values) = maths_data_generator_mid( cfg, x, MathsToken.MINUS, y, batch )
+    batch = maths_data_generator_mid( cfg, x, MathsToken.MINUS, y, batch )
 
-    # Elementwise operations to give the 1D tensor answers
-    answers = x_values - y_values
-
-    return maths_data_generator_end( cfg, answers, batch )
+    return maths_data_generator_end( cfg, x, MathsToken.MINUS, y, batch )
 
 
 # Generate an (optionally enriched) data batch for  
 # "Multiplication" batch entries formated as 000XXX*000YYY=+ZZZZZZ e.g. 000345*000678=+233910
-def maths_data_generator_multiplication( cfg, enrich_data=True ):
+def maths_data_generator_multiplication( cfg, enrich_data=True, rng=None, batch=None ):
 
-    (batch, x, y) = maths_data_generator_start( cfg )
+    (batch, x, y) = maths_data_generator_start( cfg, rng, batch )
 
     # Convert from NNNNNN*NNNNNN= to 000NNN*000NNN= so answer (product) is +0NNNNNN
     num_zeros = cfg.n_digits // 2
@@ -137,119 +143,300 @@ def maths_data_generator_multiplication( cfg, enrich_data=True ):
         # No data enrichment yet, but could be added in the future
         pass
 
-    (batch, x_values, y_values) = maths_data_generator_mid( cfg, x, MathsToken.MULT, y, batch )
+    batch = maths_data_generator_mid( cfg, x, MathsToken.MULT, y, batch )
+
+    return maths_data_generator_end( cfg, x, MathsToken.MULT, y, batch )
+
 
-    # Elementwise operations to give the 1D tensor answers
-    answers = x_values * y_values
+# Generates an (optionally enriched) data batch containing ONE maths operation.
+def maths_data_generator_core( cfg, enrich_data=True, rng=None ):
 
-    return maths_data_generator_end( cfg, answers, batch )
+    batch_rand = random_int(1, 100, rng)
+    if batch_rand <= cfg.perc_mult:
+        return maths_data_generator_multiplication( cfg, enrich_data, rng )
+    elif batch_rand <= cfg.perc_mult + cfg.perc_sub:
+        return maths_data_generator_subtraction( cfg, enrich_data, rng )
+    else:
+        return maths_data_generator_addition( cfg, enrich_data, rng )
 
 
 # Define "iterator" maths "questions" data generator function. Invoked using next().
-# Generates an (optionally enriched) data batch containing ONE maths operation.
+# Generates an (optionally enriched) data batch containing ONE maths operation. Batches are built on cfg.data_device.
 def maths_data_generator( cfg, enrich_data=True ):
     while True:
 
-        batch_rand = random.randint(1, 100)
-        if batch_rand <= cfg.perc_mult:
-            batch = maths_data_generator_multiplication( cfg, enrich_data )
-        elif batch_rand <= cfg.perc_mult + cfg.perc_sub:
-            batch = maths_data_generator_subtraction( cfg, enrich_data )
-        else:
-            batch = maths_data_generator_addition( cfg, enrich_data )
+        batch = maths_data_generator_core( cfg, enrich_data )
 
-        yield batch.cuda()
+        yield batch
         
 
-def maths_data_generator_mixed_core( cfg, enrich_data=True ):
+# Generates a data batch for multiple maths operations, with cfg.perc_add/perc_sub/perc_mult % of the questions of each operation.
+# Exactly the needed questions for each operation are generated into one preallocated batch.
+# By default the operations are stacked in blocks. If shuffle is True the question rows are shuffled so the operations are interleaved.
+def maths_data_generator_mixed_core( cfg, enrich_data=True, rng=None, shuffle=False ):
     
     if cfg.perc_add == 100:
-        return maths_data_generator_addition( cfg, enrich_data )
+        return maths_data_generator_addition( cfg, enrich_data, rng )
     elif cfg.perc_sub == 100:
-        return maths_data_generator_subtraction( cfg, enrich_data )
+        return maths_data_generator_subtraction( cfg, enrich_data, rng )
     elif cfg.perc_mult == 100:
-        return maths_data_generator_multiplication( cfg, enrich_data )
-    elif cfg.perc_mult == 0:
-        # A mixture of add and sub
-        batch1 = maths_data_generator_addition( cfg, enrich_data )
-        batch2 = maths_data_generator_subtraction( cfg, enrich_data )
-       
-        # Return a mixed batch with cfg.sub_perc % of subtraction questions, rest addition
-        num_sub = cfg.batch_size*cfg.perc_sub//100
-        num_add = cfg.batch_size - num_sub
-        return torch.cat((batch1[:num_add], batch2[:num_sub]), 0)
-    else:
-        # A mixture of add, sub and mult
-        batch1 = maths_data_generator_addition( cfg, enrich_data )
-        batch2 = maths_data_generator_subtraction( cfg, enrich_data )
-        batch3 = maths_data_generator_multiplication( cfg, enrich_data )
-       
-        # Return a mixed batch 
-        num_sub = cfg.batch_size*cfg.perc_sub//100
-        num_mult = cfg.batch_size*cfg.perc_mult//100
-        num_add = cfg.batch_size - num_sub - num_mult       
-        return torch.cat((batch1[:num_add], batch2[:num_sub], batch3[:num_mult]), 0)
-    
+        return maths_data_generator_multiplication( cfg, enrich_data, rng )
+
+    # A mixture of add, sub and (optionally) mult
+    num_sub = cfg.batch_size*cfg.perc_sub//100
+    num_mult = cfg.batch_size*cfg.perc_mult//100
+    num_add = cfg.batch_size - num_sub - num_mult
+
+    batch = torch.empty((cfg.batch_size, cfg.n_ctx), dtype=cfg.token_dtype, device=cfg.data_device)
+    maths_data_generator_addition( cfg, enrich_data, rng, batch[:num_add] )
+    maths_data_generator_subtraction( cfg, enrich_data, rng, batch[num_add:num_add+num_sub] )
+    if num_mult > 0:
+        maths_data_generator_multiplication( cfg, enrich_data, rng, batch[num_add+num_sub:] )
+
+    if shuffle:
+        batch = batch[torch.randperm(cfg.batch_size, generator=rng, device=batch.device)]
+
+    return batch
     
 
 # Define "iterator" maths "questions" data generator function. Invoked using next().
-# Generates a data batch for multiple maths operation.
-def maths_data_generator_mixed( cfg, enrich_data=True ):
+# Generates a data batch for multiple maths operation. Batches are built on cfg.data_device.
+def maths_data_generator_mixed( cfg, enrich_data=True, shuffle=False ):
     while True:
 
-        batch = maths_data_generator_mixed_core( cfg, enrich_data )
+        batch = maths_data_generator_mixed_core( cfg, enrich_data, shuffle=shuffle )
+
+        yield batch
+        
+
+# Return batch number batch_index of the counter-based question stream for seed (refer make_batch_rng).
+# The batch is identical however many batches were generated before it, and in whichever process it is generated.
+# If on_cpu, the batch is generated on the CPU then moved to cfg.data_device, so the questions do not depend on cfg.data_device.
+def maths_data_generator_batch_at( cfg, seed, batch_index, enrich_data=True, mixed=False, on_cpu=False ):
+    if on_cpu:
+        stream_cfg = copy.copy(cfg)
+        stream_cfg.data_device_name = "cpu"
+        return maths_data_generator_batch_at( stream_cfg, seed, batch_index, enrich_data, mixed ).to(cfg.data_device)
+
+    rng = make_batch_rng( cfg, seed, batch_index )
+    if mixed:
+        return maths_data_generator_mixed_core( cfg, enrich_data, rng )
+    return maths_data_generator_core( cfg, enrich_data, rng )
 
-        yield batch.cuda()
+
+# Define "iterator" counter-based maths "questions" data generator function. Invoked using next().
+# Yields batches start_index, start_index+1, ..., stop_index-1 (forever if stop_index is None) of the question stream for seed.
+# If seed is None, cfg.analysis_seed is used. Set mixed=True for maths_data_generator_mixed style batches.
+# Set on_cpu=True for the same questions on every device (refer maths_data_generator_batch_at).
+def maths_data_generator_indexed( cfg, seed=None, enrich_data=True, start_index=0, stop_index=None, mixed=False, on_cpu=False ):
+    if seed is None:
+        seed = cfg.analysis_seed
+
+    batch_index = start_index
+    while stop_index is None or batch_index < stop_index:
+
+        yield maths_data_generator_batch_at( cfg, seed, batch_index, enrich_data, mixed, on_cpu )
+
+        batch_index += 1
+        
+
+# Return the exclusive upper limit of the operands of the questions for operator. Multiplication questions (refer
+# maths_data_generator_multiplication) have n_digits//2 leading zeros in each operand, so the product fits in the answer.
+def maths_operand_limit( cfg, operator ):
+    if operator == MathsToken.MULT:
+        return 10 ** (cfg.n_digits - cfg.n_digits // 2)
+    return 10 ** cfg.n_digits
+
+
+# Return the number of possible questions for operator (refer maths_data_generator_exhaustive)
+def maths_exhaustive_num_questions( cfg, operator ):
+    return maths_operand_limit( cfg, operator ) ** 2
+
+
+# Define "iterator" that yields every possible question for the operator (all first and second operand pairs, in order)
+# in chunks of chunk_size questions (default cfg.batch_size). Operands are limited as per maths_operand_limit.
+# There are up to 10^(2*n_digits) questions, so only practical for small n_digits.
+def maths_data_generator_exhaustive( cfg, operator, chunk_size=None ):
+    if chunk_size is None:
+        chunk_size = cfg.batch_size
+    limit = maths_operand_limit( cfg, operator )
+    num_questions = limit * limit
+
+    for start in range(0, num_questions, chunk_size):
+        pair_index = torch.arange(start, min(start + chunk_size, num_questions), device=cfg.data_device)
+        x = ints_to_digits(pair_index // limit, cfg.n_digits)
+        y = ints_to_digits(pair_index % limit, cfg.n_digits)
+
+        batch = torch.empty((pair_index.shape[0], cfg.n_ctx), dtype=cfg.token_dtype, device=cfg.data_device)
+        maths_data_generator_mid( cfg, x, operator, y, batch )
+        maths_data_generator_end( cfg, x, operator, y, batch )
+
+        yield batch
+
+
+# Wraps a maths data batch iterator (e.g. maths_data_generator) or batch function (e.g. maths_data_generator_mixed_core).
+# A background thread generates batches ahead of time into a bounded queue of "depth" batches,
+# so that batch generation overlaps the model forward pass. Invoked using next().
+# Call close() (or use in a "with" statement) to stop the background thread.
+class MathsDataPrefetcher:
+
+    # Queue markers for "source is exhausted" and "source raised an exception"
+    _END = object()
+    class _Error:
+        def __init__(self, error):
+            self.error = error
+
+    def __init__(self, source, depth=4, pin_memory=False):
+        assert depth > 0
+        self.source = (source() for _ in itertools.count()) if callable(source) else iter(source)
+        # Pinned (page-locked) CPU batches can be copied to the GPU asynchronously e.g. batch.to("cuda", non_blocking=True)
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.queue = queue.Queue(maxsize=depth)
+        self.stop_event = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+
+    # Add item to the queue, waiting while the queue is full. Returns False if close() was called while waiting.
+    def _put(self, item):
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self):
+        try:
+            for batch in self.source:
+                if self.pin_memory and batch.device.type == "cpu":
+                    batch = batch.pin_memory()
+                if not self._put(batch):
+                    return
+            self._put(MathsDataPrefetcher._END)
+        except Exception as e:
+            self._put(MathsDataPrefetcher._Error(e))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+
+        item = self.queue.get()
+        if item is MathsDataPrefetcher._END:
+            self.close()
+            raise StopIteration
+        if isinstance(item, MathsDataPrefetcher._Error):
+            self.close()
+            raise item.error
+
+        return item
+
+    # Stop the background thread and discard any prefetched batches
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.stop_event.set()
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Prefetching version of maths_data_generator. Generates batches containing ONE maths operation on a background thread.
+def maths_data_generator_prefetch( cfg, enrich_data=True, depth=4, pin_memory=False ):
+    return MathsDataPrefetcher(maths_data_generator( cfg, enrich_data ), depth=depth, pin_memory=pin_memory)
+
+
+# Prefetching version of maths_data_generator_mixed. Generates batches for multiple maths operations on a background thread.
+def maths_data_generator_mixed_prefetch( cfg, enrich_data=True, depth=4, pin_memory=False, shuffle=False ):
+    return MathsDataPrefetcher(lambda: maths_data_generator_mixed_core( cfg, enrich_data, shuffle=shuffle ), depth=depth, pin_memory=pin_memory)
         
 
-# Create a (matrix) batch of questions from a 2D matrix of ints
+# Create a set of questions and answers from q_matrix, a list (or array or [N, 2] tensor) of (first, second) operand pairs.
+# Pairs with an operand that does not fit in n_digits are skipped. If major_tag and minor_tag are given, questions whose complexity
+# does not match them are reported and skipped. The questions are encoded and checked in whole-tensor operations (not per question).
 def make_maths_questions_and_answers(cfg, operator, major_tag, minor_tag, q_matrix):
-    max_len = len(q_matrix)
-    real_len = 0
-    questions = torch.zeros((max_len, cfg.n_ctx)).to(torch.int64)
+    pairs = torch.as_tensor(q_matrix, dtype=torch.int64).reshape(-1, 2)
     limit = 10 ** cfg.n_digits
+    if limit <= torch.iinfo(torch.int64).max:
+        pairs = pairs[(pairs[:, 0] < limit) & (pairs[:, 1] < limit)]
 
-    for i in range(max_len):
-        a = q_matrix[i][0]
-        b = q_matrix[i][1]
+    x = ints_to_digits(pairs[:, 0], cfg.n_digits)
+    y = ints_to_digits(pairs[:, 1], cfg.n_digits)
+    questions = torch.zeros((pairs.shape[0], cfg.n_ctx), dtype=cfg.token_dtype)
+    maths_data_generator_mid( cfg, x, operator, y, questions )
+    maths_data_generator_end( cfg, x, operator, y, questions )
 
-        if a < limit and b < limit:
-            make_a_maths_question_and_answer(cfg, questions, real_len, a, b, operator)
+    if (major_tag != QType.UNKNOWN) and (minor_tag != MathsBehavior.UNKNOWN ):
+        # Check that the complexity of the questions matches what the test data believes it is
+        major, minor = get_maths_question_complexity_batch(cfg, questions)
+        major_code = MATHS_COMPLEXITY_MAJOR_TAGS.index(major_tag) if major_tag in MATHS_COMPLEXITY_MAJOR_TAGS else -1
+        minor_code = MATHS_COMPLEXITY_MINOR_TAGS.index(minor_tag) if minor_tag in MATHS_COMPLEXITY_MINOR_TAGS else -1
+        good = (major == major_code) & (minor == minor_code)
 
-            good = True
-            if (major_tag != QType.UNKNOWN) and (minor_tag != MathsBehavior.UNKNOWN ):
-                # Check that the complexity of the question matches what the test data believes it is
-                actual_major_tag, actual_minor_tag = get_maths_question_complexity(cfg, questions[real_len])
-                question_str = tokens_to_string(cfg, questions[real_len])
-                if not( actual_major_tag == major_tag and actual_minor_tag == minor_tag ):
-                    print("make_maths_questions_and_answers complexity: Mismatch", question_str, major_tag.value, minor_tag.value, actual_major_tag.value, actual_minor_tag.value )
-                    good = False
+        for i in torch.nonzero(~good).flatten().tolist():
+            question_str = tokens_to_string(cfg, questions[i])
+            actual_major_tag = MATHS_COMPLEXITY_MAJOR_TAGS[major[i]]
+            actual_minor_tag = MATHS_COMPLEXITY_MINOR_TAGS[minor[i]]
+            print("make_maths_questions_and_answers complexity: Mismatch", question_str, major_tag.value, minor_tag.value, actual_major_tag.value, actual_minor_tag.value )
 
-            if good:
-                real_len += 1
+        questions = questions[good]
 
-    return questions[:real_len]
+    return questions
 
 
+# Dataset of num_batches mixed maths question batches. Supports DataLoader num_workers > 0:
+# each worker generates (on the CPU) a disjoint shard of the num_batches, using the counter-based question stream
+# for seed (refer maths_data_generator_batch_at). The stream is always generated on the CPU, so the questions do not depend on the number of workers.
+# If seed is None, a single process uses the current global RNG state, and workers use cfg.analysis_seed.
 class MixedMathsDataset(IterableDataset):
-    def __init__(self, cfg, num_batches, enrich_data=True):
+    def __init__(self, cfg, num_batches, enrich_data=True, seed=None):
         self.cfg = cfg
         self.num_batches = num_batches
         self.enrich_data = enrich_data
+        self.seed = seed
         self.reset()
 
     def reset(self):
         self.current_batch = 0
 
+        worker_info = get_worker_info()
+        self.in_worker = worker_info is not None
+        self.worker_id = 0 if worker_info is None else worker_info.id
+        self.num_workers = 1 if worker_info is None else worker_info.num_workers
+
+        # The batch indexes (of num_batches) that this process generates
+        self.batch_indexes = range(self.worker_id, self.num_batches, self.num_workers)
+
     def __iter__(self):
+        self.reset()
+        if self.in_worker:
+            # Worker processes hold their own copy of cfg. Generate on the CPU. The DataLoader returns the batches to the main process.
+            self.cfg.data_device_name = "cpu"
         return self
 
     def __next__(self):
-        if self.current_batch >= self.num_batches:
+        if self.current_batch >= len(self.batch_indexes):
             self.reset()
             raise StopIteration
         
-        batch = maths_data_generator_mixed_core(self.cfg, self.enrich_data)
+        if not self.in_worker and self.seed is None:
+            batch = maths_data_generator_mixed_core(self.cfg, self.enrich_data)
+        else:
+            # The counter-based stream is always generated on the CPU (the torch generator algorithm depends on the device, refer make_batch_rng)
+            # then moved to cfg.data_device. So the questions do not depend on the number of workers or on cfg.data_device.
+            seed = self.cfg.analysis_seed if self.seed is None else self.seed
+            batch = maths_data_generator_batch_at(self.cfg, seed, self.batch_indexes[self.current_batch], self.enrich_data, mixed=True, on_cpu=True)
         self.current_batch += 1
         return batch   
 
@@ -257,6 +444,6 @@ class MixedMathsDataset(IterableDataset):
         return self.num_batches * self.cfg.batch_size
 
 
-def get_mixed_maths_dataloader(cfg, num_batches=100, enrich_data=True):
-    dataset = MixedMathsDataset(cfg, num_batches, enrich_data)
-    return DataLoader(dataset, batch_size=None, num_workers=0)
\ No newline at end of file
+def get_mixed_maths_dataloader(cfg, num_batches=100, enrich_data=True, num_workers=0, seed=None):
+    dataset = MixedMathsDataset(cfg, num_batches, enrich_data, seed)
+    return DataLoader(dataset, batch_size=None, num_workers=num_workers)
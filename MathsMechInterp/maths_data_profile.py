@@ -0,0 +1,45 @@
+import math
+import statistics
+import torch
+from MathsMechInterp.maths_complexity import get_maths_complexity_codes, maths_complexity_code_to_tags, NUM_MATHS_COMPLEXITY_CODES
+
+
+# Wilson score confidence interval for a frequency of count out of total
+def wilson_interval( count, total, confidence=0.95 ):
+    if total == 0:
+        return 0.0, 1.0
+    z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+    freq = count / total
+    denominator = 1 + z * z / total
+    centre = (freq + z * z / (2 * total)) / denominator
+    margin = z * math.sqrt(freq * (1 - freq) / total + z * z / (4 * total * total)) / denominator
+    return max(0.0, centre - margin), min(1.0, centre + margin)
+
+
+# Profile the mix of complexity classes (e.g. S0 to S5, M0 to M4, N1 to N4) produced by a maths questions data generator
+# e.g. maths_data_generator(cfg, enrich_data) or maths_data_generator_mixed(cfg, enrich_data). Pulls num_batches batches and classifies them
+# in bulk. The counts are accumulated on the batch device, so there is only one device sync (at the end).
+# Returns a dictionary of (major_tag, minor_tag) to (count, frequency, low, high) where low and high are the confidence interval bounds.
+def profile_maths_data_generator( cfg, data_generator, num_batches=100, confidence=0.95, show=True ):
+    counts = None
+    for _ in range(num_batches):
+        batch = next(data_generator)
+        batch_counts = torch.bincount(get_maths_complexity_codes(cfg, batch), minlength=NUM_MATHS_COMPLEXITY_CODES)
+        counts = batch_counts if counts is None else counts + batch_counts
+
+    counts = counts.cpu().tolist()
+    total = sum(counts)
+
+    profile = {}
+    for code, count in enumerate(counts):
+        if count > 0:
+            major_tag, minor_tag = maths_complexity_code_to_tags(code)
+            low, high = wilson_interval( count, total, confidence )
+            profile[(major_tag, minor_tag)] = (count, count / total, low, high)
+
+    if show:
+        print(f"Complexity profile of {total} questions ({confidence:.0%} confidence intervals)")
+        for (major_tag, minor_tag), (count, freq, low, high) in profile.items():
+            print(f"{major_tag.value:>10} {minor_tag.value:>7}: {count:>10} {freq:8.4%} [{low:8.4%}, {high:8.4%}]")
+
+    return profile
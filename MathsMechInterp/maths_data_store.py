@@ -0,0 +1,96 @@
+import json
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+
+# Maths data files (data stores and failure corpora, refer maths_failure_corpus) start with a fixed size header.
+# The header holds the magic bytes then a JSON dictionary (space padded), e.g. describing the MathsConfig used to generate the questions.
+MATHS_FILE_HEADER_BYTES = 4096
+
+
+# Write the magic bytes and header dictionary to the (open, empty) file f as a fixed size header
+def write_maths_file_header(f, magic, header):
+    header_bytes = magic + json.dumps(header).encode("utf-8")
+    assert len(header_bytes) <= MATHS_FILE_HEADER_BYTES, "Maths file header is too large"
+    f.write(header_bytes.ljust(MATHS_FILE_HEADER_BYTES, b" "))
+
+
+# Return the header (as a dictionary) of a maths data file. Checks the file starts with the magic bytes of the expected file type
+def read_maths_file_header(file_name, magic, file_type):
+    with open(file_name, "rb") as f:
+        header_bytes = f.read(MATHS_FILE_HEADER_BYTES)
+
+    assert header_bytes[:len(magic)] == magic, f"{file_name} is not a {file_type} file"
+    return json.loads(header_bytes[len(magic):].decode("utf-8"))
+
+
+# Check the header of a maths data file suits the model cfg
+def check_maths_file_header(cfg, header):
+    assert cfg.n_ctx == header['n_ctx']
+    assert cfg.n_digits == header['maths_config'].get('n_digits', cfg.n_digits)
+
+
+# Return the contents (after the header) of a maths data file as a [shape] tensor of dtype.
+# The file is memory-mapped. Copy-on-write mapping gives a writable (torch-compatible) view without copying the file contents
+def map_maths_file(file_name, dtype, shape):
+    memmap = np.memmap(file_name, dtype=dtype, mode='c', offset=MATHS_FILE_HEADER_BYTES, shape=shape)
+    return torch.from_numpy(memmap)
+
+
+# A maths data store file is a maths data file header followed by num_batches * batch_size * n_ctx tokens.
+MATHS_STORE_MAGIC = b"MATHSQ01"
+
+
+# Write num_batches question batches from batches (any maths data generator iterator e.g. maths_data_generator_indexed,
+# maths_data_generator_mixed or a MixedMathsDataset) to file_name. Batches are streamed to disk one at a time.
+def write_maths_data_store(cfg, file_name, batches, num_batches, description=""):
+    header = {
+        'maths_config': cfg.to_dict(),
+        'description': description,
+        'num_batches': num_batches,
+        'batch_size': cfg.batch_size,
+        'n_ctx': cfg.n_ctx,
+        'dtype': 'uint8' if cfg.compact_tokens else 'int64',
+    }
+
+    batches = iter(batches)
+    with open(file_name, "wb") as f:
+        write_maths_file_header(f, MATHS_STORE_MAGIC, header)
+        for _ in range(num_batches):
+            batch = next(batches)
+            assert batch.shape == (cfg.batch_size, cfg.n_ctx)
+            f.write(batch.cpu().numpy().astype(header['dtype']).tobytes())
+
+
+# Return the header (as a dictionary) of a maths data store file
+def read_maths_data_store_header(file_name):
+    return read_maths_file_header(file_name, MATHS_STORE_MAGIC, "maths data store")
+
+
+# Dataset of the question batches in a maths data store file (refer write_maths_data_store).
+# The file is memory-mapped, and each batch is returned as a zero-copy tensor view.
+# Many processes can share one fixed (cheap to read) question corpus.
+class MmapMathsDataset(Dataset):
+    def __init__(self, file_name, cfg=None):
+        self.file_name = file_name
+        self.header = read_maths_data_store_header(file_name)
+        self.num_batches = self.header['num_batches']
+        self.batch_size = self.header['batch_size']
+        self.n_ctx = self.header['n_ctx']
+
+        if cfg is not None:
+            check_maths_file_header(cfg, self.header)
+
+        self.tokens = map_maths_file(file_name, self.header['dtype'], (self.num_batches, self.batch_size, self.n_ctx))
+
+    def __len__(self):
+        return self.num_batches
+
+    def __getitem__(self, index):
+        return self.tokens[index]
+
+
+def get_mmap_maths_dataloader(file_name, cfg=None, num_workers=0):
+    dataset = MmapMathsDataset(file_name, cfg)
+    return DataLoader(dataset, batch_size=None, num_workers=num_workers)
@@ -0,0 +1,220 @@
+import torch
+from MathsMechInterp.maths_constants import MathsBehavior, MathsToken
+from MathsMechInterp.maths_data_generator import maths_data_generator_mid, maths_data_generator_end
+from MathsMechInterp.maths_column_arithmetic import column_cascade_lengths
+
+
+# Directly constructs addition and subtraction questions of a requested complexity class (refer get_maths_question_complexity)
+# using vectorized digit-pattern construction. There is no rejection sampling, so rare cascade classes (e.g. S5, M4+, N4+)
+# are generated as fast as common ones. Digit tensors below are [num_questions, n_digits] with the least significant digit first.
+
+
+# Addition classes (by maximum MakeCarry1 + UseSum9 cascade length), subtraction classes (by maximum BorrowOne + MakeZero cascade length)
+ADD_STRATIFIED_TAGS = [MathsBehavior.ADD_S0_TAG, MathsBehavior.ADD_S1_TAG, MathsBehavior.ADD_S2_TAG, MathsBehavior.ADD_S3_TAG, MathsBehavior.ADD_S4_TAG, MathsBehavior.ADD_S5_TAG]
+SUB_STRATIFIED_TAGS = [MathsBehavior.SUB_M0_TAG, MathsBehavior.SUB_M1_TAG, MathsBehavior.SUB_M2_TAG, MathsBehavior.SUB_M3_TAG, MathsBehavior.SUB_M4_TAG]
+NEG_STRATIFIED_TAGS = [MathsBehavior.NEG_N1_TAG, MathsBehavior.NEG_N2_TAG, MathsBehavior.NEG_N3_TAG, MathsBehavior.NEG_N4_TAG]
+
+
+# Return random [shape] digit pairs (x, y) of the requested kind of column
+def sample_digit_pairs( kind, shape, rng, device ):
+    def rand_int(low, high):
+        return torch.randint(low, high, shape, generator=rng, device=device)
+    def rand_below(limit): # Random integers in [0, limit) for a tensor of limits
+        return (torch.rand(shape, generator=rng, device=device) * limit).to(torch.int64)
+
+    if kind == "carry": # x + y >= 10 (MakeCarry1)
+        x = rand_int(1, 10)
+        return x, 10 - x + rand_below(x)
+    if kind == "nine": # x + y == 9 (MakeSum9)
+        x = rand_int(0, 10)
+        return x, 9 - x
+    if kind == "low": # x + y <= 8
+        x = rand_int(0, 9)
+        return x, rand_below(9 - x)
+    if kind == "no_carry": # x + y <= 9
+        x = rand_int(0, 10)
+        return x, rand_below(10 - x)
+    if kind == "borrow": # x < y (BorrowOne)
+        y = rand_int(1, 10)
+        return rand_below(y), y
+    if kind == "greater": # x > y
+        x = rand_int(1, 10)
+        return x, rand_below(x)
+    if kind == "equal": # x == y (MakeZero)
+        x = rand_int(0, 10)
+        return x, x
+    if kind == "equal_nonzero":
+        x = rand_int(1, 10)
+        return x, x
+    assert False, f"Unknown digit pair kind {kind}"
+
+
+# Replace the digit pairs in the mask columns with random digit pairs of the requested kind
+def set_digit_pairs( x, y, mask, kind, rng ):
+    new_x, new_y = sample_digit_pairs( kind, x.shape, rng, x.device )
+    return torch.where(mask, new_x, x), torch.where(mask, new_y, y)
+
+
+# Given [num_questions, n_digits] "generate" (e.g. MakeCarry1) and "propagate" (e.g. MakeSum9) column masks, return a mask of the
+# columns that extend a cascade beyond max_length. That is, the (max_length+1)th propagate column in a run that follows a generate column.
+# Replacing these columns with non-generate, non-propagate columns limits every cascade to max_length.
+def cascade_overflow_mask( generate, propagate, max_length ):
+    return column_cascade_lengths( generate, propagate ) == max_length + 1
+
+
+# Random [num_questions] column index in the range [low, high] (inclusive). high may differ per question.
+def random_column( num_questions, low, high, rng, device ):
+    return low + (torch.rand(num_questions, generator=rng, device=device) * (high - low + 1)).to(torch.int64)
+
+
+# Return the x, y digits (least significant first) of num_questions addition questions of class ADD_S0_TAG to ADD_S5_TAG
+def synthesize_addition_digits( cfg, tag, num_questions, rng=None ):
+    n_digits = cfg.n_digits
+    device = cfg.data_device
+    k = ADD_STRATIFIED_TAGS.index(tag)
+    if k == 0:
+        # No MakeCarry1 columns
+        return sample_digit_pairs( "no_carry", (num_questions, n_digits), rng, device )
+
+    x = torch.randint(0, 10, (num_questions, n_digits), generator=rng, device=device)
+    y = torch.randint(0, 10, (num_questions, n_digits), generator=rng, device=device)
+
+    cascade_length = k - 1 # S1 has no cascade, S5 has a cascade of 4 or more
+    assert n_digits >= cascade_length + 1, f"{tag.value} questions need at least {cascade_length + 1} digits"
+
+    if tag != MathsBehavior.ADD_S5_TAG:
+        # Limit the existing (random) cascades to cascade_length
+        overflow = cascade_overflow_mask( x + y > 9, x + y == 9, cascade_length )
+        x, y = set_digit_pairs( x, y, overflow, "low", rng )
+
+    # Plant a MakeCarry1 column followed by cascade_length MakeSum9 columns, then a cascade-stopping column
+    index = torch.arange(n_digits, device=device)
+    start = random_column( num_questions, 0, n_digits - 1 - cascade_length, rng, device ).unsqueeze(1)
+    x, y = set_digit_pairs( x, y, index == start, "carry", rng )
+    x, y = set_digit_pairs( x, y, (index > start) & (index <= start + cascade_length), "nine", rng )
+    x, y = set_digit_pairs( x, y, index == start + cascade_length + 1, "low", rng )
+
+    return x, y
+
+
+# Return the x, y digits (least significant first) of num_questions positive-answer subtraction questions of class SUB_M0_TAG to SUB_M4_TAG
+def synthesize_subtraction_digits( cfg, tag, num_questions, rng=None ):
+    n_digits = cfg.n_digits
+    device = cfg.data_device
+    k = SUB_STRATIFIED_TAGS.index(tag)
+    x = torch.randint(0, 10, (num_questions, n_digits), generator=rng, device=device)
+    y = torch.randint(0, 10, (num_questions, n_digits), generator=rng, device=device)
+    if k == 0:
+        # No BorrowOne columns (so the answer is also not negative)
+        return torch.maximum(x, y), torch.minimum(x, y)
+
+    cascade_length = k - 1 # M1 has no cascade, M4+ has a cascade of 3 or more
+    assert n_digits >= cascade_length + 2, f"{tag.value} questions need at least {cascade_length + 2} digits"
+
+    if tag != MathsBehavior.SUB_M4_TAG:
+        # Limit the existing (random) cascades to cascade_length
+        overflow = cascade_overflow_mask( x < y, x == y, cascade_length )
+        x, y = set_digit_pairs( x, y, overflow, "greater", rng )
+
+    # The most significant differing column must have x > y so the answer is positive.
+    # Leave room below it for the cascade. Any columns above it are already equal.
+    index = torch.arange(n_digits, device=device)
+    top_differing = torch.where(x != y, index, -1).max(dim=1).values
+    top = torch.clamp(top_differing, min=cascade_length + 1).unsqueeze(1)
+    x, y = set_digit_pairs( x, y, index == top, "greater", rng )
+
+    # Plant a BorrowOne column followed by cascade_length MakeZero columns, then a cascade-stopping column (at or below top)
+    start = random_column( num_questions, 0, top.squeeze(1) - cascade_length - 1, rng, device ).unsqueeze(1)
+    x, y = set_digit_pairs( x, y, index == start, "borrow", rng )
+    x, y = set_digit_pairs( x, y, (index > start) & (index <= start + cascade_length), "equal", rng )
+    x, y = set_digit_pairs( x, y, index == start + cascade_length + 1, "greater", rng )
+
+    return x, y
+
+
+# Return the x, y digits (least significant first) of num_questions negative-answer subtraction questions of class NEG_N1_TAG to NEG_N4_TAG
+def synthesize_negative_digits( cfg, tag, num_questions, rng=None ):
+    n_digits = cfg.n_digits
+    device = cfg.data_device
+    k = NEG_STRATIFIED_TAGS.index(tag)
+    x = torch.randint(0, 10, (num_questions, n_digits), generator=rng, device=device)
+    y = torch.randint(0, 10, (num_questions, n_digits), generator=rng, device=device)
+
+    cascade_length = k # N1 has no cascade, N4+ has a cascade of 3 or more
+    assert n_digits >= cascade_length + 1, f"{tag.value} questions need at least {cascade_length + 1} digits"
+
+    # The most significant differing column is a BorrowOne (so the answer is negative). It is followed by cascade_length
+    # MakeZero columns, the highest of which is non-zero so they are within the question digits. Higher columns are zero.
+    index = torch.arange(n_digits, device=device)
+    top = random_column( num_questions, 0, n_digits - 1 - cascade_length, rng, device ).unsqueeze(1)
+    x, y = set_digit_pairs( x, y, index == top, "borrow", rng )
+    x, y = set_digit_pairs( x, y, (index > top) & (index < top + cascade_length), "equal", rng )
+    x, y = set_digit_pairs( x, y, (index == top + cascade_length) & (index > top), "equal_nonzero", rng )
+    x = torch.where(index > top + cascade_length, 0, x)
+    y = torch.where(index > top + cascade_length, 0, y)
+
+    if tag != MathsBehavior.NEG_N4_TAG:
+        # Limit the (random) cascades below the top column to cascade_length
+        overflow = cascade_overflow_mask( x < y, x == y, cascade_length ) & (index < top)
+        x, y = set_digit_pairs( x, y, overflow, "greater", rng )
+
+    return x, y
+
+
+# Split num_questions into integer counts proportional to weights (largest remainder method)
+def stratified_counts( num_questions, weights ):
+    total = sum(weights)
+    exact = [num_questions * weight / total for weight in weights]
+    counts = [int(value) for value in exact]
+    by_remainder = sorted(range(len(weights)), key=lambda i: exact[i] - counts[i], reverse=True)
+    for i in by_remainder[:num_questions - sum(counts)]:
+        counts[i] += 1
+    return counts
+
+
+# Generates a batch of cfg.batch_size addition and subtraction questions with a requested mix of complexity classes.
+# class_weights maps complexity tags (e.g. MathsBehavior.ADD_S3_TAG, SUB_M2_TAG, NEG_N4_TAG) to relative weights.
+# If shuffle is True the question rows are shuffled so the classes are interleaved.
+def maths_data_generator_stratified_core( cfg, class_weights, rng=None, shuffle=True ):
+    tags = list(class_weights.keys())
+    counts = stratified_counts( cfg.batch_size, [class_weights[tag] for tag in tags] )
+
+    batch = torch.empty((cfg.batch_size, cfg.n_ctx), dtype=cfg.token_dtype, device=cfg.data_device)
+    offset = 0
+    for tag, count in zip(tags, counts):
+        if count == 0:
+            continue
+
+        if tag in ADD_STRATIFIED_TAGS:
+            x, y = synthesize_addition_digits( cfg, tag, count, rng )
+            operator = MathsToken.PLUS
+        elif tag in SUB_STRATIFIED_TAGS:
+            x, y = synthesize_subtraction_digits( cfg, tag, count, rng )
+            operator = MathsToken.MINUS
+        elif tag in NEG_STRATIFIED_TAGS:
+            x, y = synthesize_negative_digits( cfg, tag, count, rng )
+            operator = MathsToken.MINUS
+        else:
+            assert False, f"Unsupported complexity tag {tag}"
+
+        # Convert to most significant digit first (as per the question tokens)
+        x = x.flip(1)
+        y = y.flip(1)
+        rows = batch[offset:offset+count]
+        maths_data_generator_mid( cfg, x, operator, y, rows )
+        maths_data_generator_end( cfg, x, operator, y, rows )
+        offset += count
+
+    if shuffle:
+        batch = batch[torch.randperm(cfg.batch_size, generator=rng, device=batch.device)]
+
+    return batch
+
+
+# Define "iterator" complexity-stratified maths "questions" data generator function. Invoked using next().
+def maths_data_generator_stratified( cfg, class_weights, shuffle=True ):
+    while True:
+
+        batch = maths_data_generator_stratified_core( cfg, class_weights, shuffle=shuffle )
+
+        yield batch
@@ -0,0 +1,108 @@
+import math
+import time
+import weakref
+import torch
+from QuantaMechInterp import a_predict_questions
+from MathsMechInterp.maths_utilities import widen_tokens
+from MathsMechInterp.maths_data_generator import maths_data_generator_mixed_core, make_batch_rng
+
+
+# Evaluation (as opposed to training) of the model on maths questions. Evaluation runs under torch.inference_mode (no autograd
+# state is kept) and uses the largest batch size that fits in memory, rather than the (small) training cfg.batch_size.
+# Any number of questions can be evaluated. They are split into chunks of the evaluation batch size automatically.
+
+
+# Evaluation batch sizes found by probe_maths_eval_batch_size, keyed by model. Weakly keyed, so models are not kept alive by the cache
+_maths_eval_batch_sizes = weakref.WeakKeyDictionary()
+
+
+def is_out_of_memory_error(e):
+    return isinstance(e, torch.cuda.OutOfMemoryError) or "out of memory" in str(e).lower()
+
+
+# Run the model on one chunk of questions (with the_hooks, if any). Returns all_losses_raw and all_max_prob_tokens (as per a_predict_questions)
+def predict_maths_questions_chunk(cfg, questions, the_hooks=None):
+    with torch.inference_mode():
+        return a_predict_questions(cfg, widen_tokens(questions), the_hooks)
+
+
+# Find the evaluation batch size with the best throughput for cfg.main_model, by doubling the batch size (from cfg.batch_size)
+# until the model runs out of memory, max_batch_size is reached, or the throughput (questions per second) improves by less than min_speedup.
+# On CPU the throughput levels off long before memory runs out. On GPU the largest batch that fits is usually found.
+def probe_maths_eval_batch_size(cfg, max_batch_size=65536, min_speedup=1.1):
+    sample_questions = maths_data_generator_mixed_core(cfg, False, rng=make_batch_rng(cfg, cfg.analysis_seed, 0))
+
+    def questions_per_second(batch_size):
+        questions = sample_questions.repeat(math.ceil(batch_size / sample_questions.shape[0]), 1)[:batch_size]
+        start_time = time.perf_counter()
+        _, all_max_prob_tokens = predict_maths_questions_chunk(cfg, questions)
+        if all_max_prob_tokens.is_cuda:
+            torch.cuda.synchronize()
+        return batch_size / (time.perf_counter() - start_time)
+
+    questions_per_second(cfg.batch_size) # Warm up
+    best_batch_size = cfg.batch_size
+    best_rate = questions_per_second(cfg.batch_size)
+
+    batch_size = 2 * cfg.batch_size
+    while batch_size <= max_batch_size:
+        try:
+            rate = questions_per_second(batch_size)
+        except RuntimeError as e:
+            if not is_out_of_memory_error(e):
+                raise
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            break
+
+        if rate < best_rate * min_speedup:
+            break
+        best_batch_size = batch_size
+        best_rate = rate
+        batch_size *= 2
+
+    _maths_eval_batch_sizes[cfg.main_model] = best_batch_size
+    return best_batch_size
+
+
+# Return the evaluation batch size for cfg.main_model. Probes for it (refer probe_maths_eval_batch_size) the first time a model is evaluated.
+def get_maths_eval_batch_size(cfg):
+    batch_size = _maths_eval_batch_sizes.get(cfg.main_model)
+    if batch_size is None:
+        batch_size = probe_maths_eval_batch_size(cfg)
+    return batch_size
+
+
+# Predict the answers to any number of questions (with the_hooks, if any) under inference mode, in chunks of batch_size
+# (default get_maths_eval_batch_size). If a chunk runs out of memory the batch size is halved and the chunk retried.
+# Ablation hooks may hold activations for exactly the questions being tested, so questions run with hooks are not chunked.
+# Returns all_losses_raw and all_max_prob_tokens (as per a_predict_questions) for all the questions.
+def predict_maths_questions(cfg, questions, the_hooks=None, batch_size=None):
+    if the_hooks is not None or questions.shape[0] == 0:
+        return predict_maths_questions_chunk(cfg, questions, the_hooks)
+
+    if batch_size is None:
+        batch_size = get_maths_eval_batch_size(cfg)
+
+    all_losses_raw = []
+    all_max_prob_tokens = []
+    start = 0
+    while start < questions.shape[0]:
+        try:
+            chunk_losses_raw, chunk_max_prob_tokens = predict_maths_questions_chunk(cfg, questions[start:start+batch_size])
+        except RuntimeError as e:
+            if not is_out_of_memory_error(e) or batch_size == 1:
+                raise
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            batch_size = batch_size // 2
+            _maths_eval_batch_sizes[cfg.main_model] = batch_size
+            continue
+
+        all_losses_raw.append(chunk_losses_raw)
+        all_max_prob_tokens.append(chunk_max_prob_tokens)
+        start += batch_size
+
+    if len(all_losses_raw) == 1:
+        return all_losses_raw[0], all_max_prob_tokens[0]
+    return torch.cat(all_losses_raw), torch.cat(all_max_prob_tokens)
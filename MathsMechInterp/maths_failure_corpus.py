@@ -0,0 +1,88 @@
+import os
+import numpy as np
+import torch
+from MathsMechInterp.maths_complexity import get_maths_complexity_codes
+from MathsMechInterp.maths_utilities import widen_tokens
+from MathsMechInterp.maths_data_store import (MATHS_FILE_HEADER_BYTES, write_maths_file_header, read_maths_file_header,
+    check_maths_file_header, map_maths_file)
+
+
+# A maths failure corpus file is a maths data file header (refer write_maths_file_header) followed by one fixed size float32 record per failing question.
+# Each record is the n_ctx question (and correct answer) tokens, the num_answer_positions model answer tokens,
+# the num_answer_positions raw answer losses (as per a_predict_questions) then the complexity code (refer get_maths_complexity_codes).
+# The tokens are stored as float32 (not cfg.token_dtype) so the whole corpus loads as one tensor. Failures are rare, so the corpus stays small.
+# Records are only ever appended, so the corpus can be written to during long correctness runs (refer test_correctness_on_num_questions_core).
+MATHS_FAILURE_MAGIC = b"MATHSF01"
+
+
+# Number of float32 values in each failure corpus record
+def maths_failure_record_width(cfg):
+    return cfg.n_ctx + 2 * cfg.num_answer_positions + 1
+
+
+# Append the failing questions (a [F, n_ctx] tensor), the model's answers ([F, num_answer_positions] tokens) and the raw answer losses
+# ([F, num_answer_positions]) to the failure corpus file_name. Creates the file (with its header) if it does not exist.
+def append_maths_failure_corpus(cfg, file_name, questions, model_answers, losses_raw, description=""):
+    if not os.path.exists(file_name) or os.path.getsize(file_name) == 0:
+        header = {
+            'maths_config': cfg.to_dict(),
+            'description': description,
+            'n_ctx': cfg.n_ctx,
+            'num_answer_positions': cfg.num_answer_positions,
+            'record_width': maths_failure_record_width(cfg),
+            'dtype': 'float32',
+        }
+        with open(file_name, "wb") as f:
+            write_maths_file_header(f, MATHS_FAILURE_MAGIC, header)
+    else:
+        header = read_maths_failure_corpus_header(file_name)
+        assert header['n_ctx'] == cfg.n_ctx and header['num_answer_positions'] == cfg.num_answer_positions, f"{file_name} is for a different model shape"
+
+    if questions.shape[0] == 0:
+        return
+
+    questions = widen_tokens(questions)
+    codes = get_maths_complexity_codes(cfg, questions)
+    records = torch.cat((
+        questions.cpu().to(torch.float32),
+        model_answers.cpu().to(torch.float32),
+        losses_raw.detach().cpu().to(torch.float32),
+        codes.cpu().to(torch.float32).unsqueeze(1)), dim=1)
+    assert records.shape[1] == header['record_width']
+
+    with open(file_name, "ab") as f:
+        f.write(records.numpy().tobytes())
+
+
+# Return the header (as a dictionary) of a maths failure corpus file
+def read_maths_failure_corpus_header(file_name):
+    return read_maths_file_header(file_name, MATHS_FAILURE_MAGIC, "maths failure corpus")
+
+
+# Return the records of a maths failure corpus file as a single [num_fails, record_width] float32 tensor (refer split_maths_failure_corpus).
+# The file is memory-mapped, so loading is fast even for large corpora. A partial record at the end (from an interrupted append) is ignored.
+def load_maths_failure_corpus(file_name, cfg=None):
+    header = read_maths_failure_corpus_header(file_name)
+    if cfg is not None:
+        check_maths_file_header(cfg, header)
+        assert cfg.num_answer_positions == header['num_answer_positions']
+
+    record_width = header['record_width']
+    num_fails = (os.path.getsize(file_name) - MATHS_FILE_HEADER_BYTES) // (record_width * np.dtype(header['dtype']).itemsize)
+    if num_fails == 0:
+        return torch.zeros((0, record_width), dtype=torch.float32)
+
+    return map_maths_file(file_name, header['dtype'], (num_fails, record_width))
+
+
+# Split failure corpus records (refer load_maths_failure_corpus) into the [F, n_ctx] questions, [F, num_answer_positions] model answers,
+# [F, num_answer_positions] raw answer losses and [F] complexity codes. The questions can be re-tested directly e.g. with predict_maths_question_fails
+def split_maths_failure_corpus(cfg, corpus):
+    answer_start = cfg.n_ctx
+    loss_start = answer_start + cfg.num_answer_positions
+    code_start = loss_start + cfg.num_answer_positions
+    questions = corpus[:, :answer_start].to(torch.int64)
+    model_answers = corpus[:, answer_start:loss_start].to(torch.int64)
+    losses_raw = corpus[:, loss_start:code_start]
+    codes = corpus[:, code_start].to(torch.int64)
+    return questions, model_answers, losses_raw, codes
@@ -1,6 +1,7 @@
 import matplotlib.pyplot as plt
 from QuantaMechInterp import NodeLocation, answer_name, calc_pca_for_an, QType, token_to_char, save_plt_to_file
 from MathsMechInterp.maths_constants import MathsBehavior, MathsToken
+from MathsMechInterp.maths_utilities import widen_tokens
 from MathsMechInterp.MathsTestQuestions.tricase_test_questions_generator import EACH_CASE_TRICASE_QUESTIONS
 
 
@@ -29,7 +30,7 @@ def _build_title_and_error_message(cfg, node_location : NodeLocation, operation,
 
 def manual_node_pca(cfg, ax, position : int, layer : int, num : int, operation : MathsToken, answer_digit : int):
     node_location = NodeLocation(position, layer, True, num)
-    test_inputs = cfg.tricase_questions_dict[(answer_digit, operation)]
+    test_inputs = widen_tokens(cfg.tricase_questions_dict[(answer_digit, operation)])
 
     title, error_message = _build_title_and_error_message(
         cfg=cfg, node_location=node_location, operation=operation, answer_digit=answer_digit
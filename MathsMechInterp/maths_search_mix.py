@@ -3,7 +3,7 @@ from QuantaMechInterp import (QType, a_run_attention_intervention, NO_IMPACT_TAG
     FilterAnd, FilterHead, FilterPosition, FilterAttention, FilterImpact, QCondition)
 from MathsMechInterp.maths_constants import MathsToken, MathsBehavior, MathsTask 
 from MathsMechInterp.maths_data_generator import make_maths_questions_and_answers
-from MathsMechInterp.maths_utilities import int_to_answer_str 
+from MathsMechInterp.maths_utilities import int_to_answer_str, widen_tokens
 
 
 def run_intervention_core(cfg, acfg, store_question, clean_question, expected_answer_impact, expected_answer_int, strong):
@@ -22,8 +22,8 @@ def run_intervention_core(cfg, acfg, store_question, clean_question, expected_an
     expected_answer_str = int_to_answer_str(cfg, expected_answer_int)
 
     # Matrices of tokens
-    store_question_and_answer = make_maths_questions_and_answers(cfg, acfg.operation, QType.UNKNOWN, MathsBehavior.UNKNOWN, [store_question])
-    clean_question_and_answer = make_maths_questions_and_answers(cfg, acfg.operation, QType.UNKNOWN, MathsBehavior.UNKNOWN, [clean_question])
+    store_question_and_answer = widen_tokens(make_maths_questions_and_answers(cfg, acfg.operation, QType.UNKNOWN, MathsBehavior.UNKNOWN, [store_question]))
+    clean_question_and_answer = widen_tokens(make_maths_questions_and_answers(cfg, acfg.operation, QType.UNKNOWN, MathsBehavior.UNKNOWN, [clean_question]))
 
     acfg.reset_intervention(expected_answer_str, expected_answer_impact)
     
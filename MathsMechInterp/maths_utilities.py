@@ -1,3 +1,4 @@
+import torch
 from MathsMechInterp.maths_constants import MathsToken
 
 
@@ -36,6 +37,45 @@ def int_to_answer_str( cfg, n ):
     return s
 
 
+# Convert a 1D tensor of answers e.g. [1234, -56] into a [len(answers), n_digits+2] tensor of answer tokens e.g. "+0001234", "-0000056"
+# Uses whole-tensor operations (no per-question loop). Digits beyond n_digits+1 are truncated.
+def answers_to_tokens( cfg, answers ):
+    answer_digits = cfg.n_digits + 1
+
+    tokens = torch.empty((answers.shape[0], answer_digits + 1), dtype=torch.int64, device=answers.device)
+    tokens[:, 0] = torch.where(answers < 0, MathsToken.MINUS, MathsToken.PLUS)
+
+    powers = 10 ** torch.arange(answer_digits - 1, -1, -1, dtype=torch.int64, device=answers.device)
+    tokens[:, 1:] = (answers.abs().unsqueeze(1) // powers) % 10
+
+    return tokens
+
+
+# Convert a 1D tensor of non-negative integers e.g. [1234, 56] into a [len(values), n_digits] tensor of digits e.g. "001234", "000056"
+# (most significant digit first). Uses whole-tensor operations (no per-question loop). Digits beyond n_digits are truncated.
+def ints_to_digits( values, n_digits ):
+    digits = torch.empty((values.shape[0], n_digits), dtype=torch.int64, device=values.device)
+    for j in range(n_digits):
+        digits[:, n_digits-1-j] = values % 10
+        values = values // 10
+    return digits
+
+
+# Convert a [B, n_digits] tensor of digits e.g. "001234", "000056" (most significant digit first) into a 1D tensor of integers e.g. [1234, 56].
+# Uses whole-tensor operations (no per-question loop).
+def digits_to_ints( digits ):
+    values = torch.zeros(digits.shape[0], dtype=torch.int64, device=digits.device)
+    for j in range(digits.shape[1]):
+        values = values * 10 + digits[:, j]
+    return values
+
+
+# Widen compact (uint8) question tokens to the int64 tokens that the model embedding (and loss calculation) requires.
+# Returns tokens unchanged (no copy) if they are already int64.
+def widen_tokens( tokens ):
+    return tokens.to(torch.int64)
+
+
 # Convert "0012345" to 12345
 def tokens_to_unsigned_int( q, offset, digits ):
     a = 0
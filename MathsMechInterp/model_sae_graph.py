@@ -4,6 +4,8 @@ import matplotlib.pyplot as plt
 from sklearn.manifold import TSNE
 import transformer_lens.utils as utils
 
+from MathsMechInterp.maths_utilities import widen_tokens
+
 
 def generate_encodings(model, sae, dataloader, layer_num, max_samples=10000):
     encodings = []
@@ -22,7 +24,7 @@ def generate_encodings(model, sae, dataloader, layer_num, max_samples=10000):
     try:
         with torch.no_grad():
             for batch in dataloader:
-                _ = model(batch)
+                _ = model(widen_tokens(batch))
                 if sample_count >= max_samples:
                     break
     finally:
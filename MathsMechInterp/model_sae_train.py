@@ -10,6 +10,7 @@ from skopt.space import Real, Integer
 from skopt.utils import use_named_args
 
 from QuantaMechInterp.model_sae import AdaptiveSparseAutoencoder, save_sae_to_huggingface
+from MathsMechInterp.maths_utilities import widen_tokens
 
 
 def train_sae_epoch(sae, activation_generator, epoch, learning_rate, max_grad_norm=1.0):
@@ -94,7 +95,7 @@ def analyze_mlp_with_sae(
         try:
             main_model.add_hook(hook_name, store_activations_hook)
             for batch in dataloader:          
-                _ = main_model(batch)
+                _ = main_model(widen_tokens(batch))
                 yield torch.cat(activations, dim=0)
                 activations = []                                
         finally:
@@ -1,19 +1,37 @@
+import contextlib
+import gc
+import io
+import os
+import tempfile
+import types
 import torch
 import unittest
+import weakref
 
 from transformer_lens import HookedTransformer
 from transformer_lens.utils import download_file_from_hf
-from QuantaMechInterp import UsefulNodeList, NodeLocation, token_to_char, tokens_to_string, sort_unique_digits, QType, get_quanta_attention, get_quanta_impact, MATH_SUB_SHADES, MATH_ADD_SHADES
+from QuantaMechInterp import UsefulNodeList, NodeLocation, token_to_char, tokens_to_string, sort_unique_digits, get_question_answer_impact, QType, get_quanta_attention, get_quanta_impact, MATH_SUB_SHADES, MATH_ADD_SHADES
 
+import MathsMechInterp
 from MathsMechInterp import make_maths_tricase_questions
 from MathsMechInterp.maths_config import MathsConfig
 from MathsMechInterp.maths_constants import MathsToken, MathsBehavior
-from MathsMechInterp.maths_utilities import set_maths_vocabulary, int_to_answer_str, tokens_to_unsigned_int
-from MathsMechInterp.maths_data_generator import maths_data_generator_addition, maths_data_generator_subtraction, maths_data_generator_multiplication, maths_data_generator_mixed, maths_data_generator_mixed_core, make_maths_questions_and_answers
+from MathsMechInterp.maths_utilities import set_maths_vocabulary, int_to_answer_str, tokens_to_unsigned_int, answers_to_tokens, widen_tokens
+from MathsMechInterp.maths_data_generator import (maths_data_generator_addition, maths_data_generator_subtraction, maths_data_generator_multiplication, maths_data_generator_mixed, maths_data_generator_mixed_core, make_maths_questions_and_answers, maths_data_generator_mixed_prefetch, get_mixed_maths_dataloader,
+    maths_data_generator_indexed, maths_data_generator_batch_at, maths_data_generator_exhaustive, maths_exhaustive_num_questions)
+from MathsMechInterp.maths_column_arithmetic import column_answers_to_tokens
+from MathsMechInterp.maths_data_store import write_maths_data_store, read_maths_data_store_header, MmapMathsDataset
+from MathsMechInterp.maths_evaluation import predict_maths_questions, get_maths_eval_batch_size
+from MathsMechInterp.maths_ablation import get_maths_node_mean_values, get_maths_stacked_ablation_hooks, get_maths_stacked_position_ablation_hooks
+from MathsMechInterp.maths_failure_corpus import append_maths_failure_corpus, load_maths_failure_corpus, split_maths_failure_corpus
+from MathsMechInterp.maths_data_stratified import maths_data_generator_stratified, maths_data_generator_stratified_core
+from MathsMechInterp.maths_data_profile import profile_maths_data_generator
+from MathsMechInterp.MathsTestQuestions.test_questions_checker import get_maths_question_fails, get_nines_decision, get_nines_fail_budget, get_nines_check_num, get_nines_check_confidence, save_correctness_state, merge_correctness_states
 from MathsMechInterp.MathsTestQuestions import make_maths_s0_questions_and_answers, make_maths_s1_questions_and_answers, make_maths_s2_questions_and_answers, make_maths_s3_questions_and_answers, make_maths_s4_questions_and_answers, make_maths_s5_questions_and_answers
 from MathsMechInterp.MathsTestQuestions import make_maths_m0_questions_and_answers, make_maths_m1_questions_and_answers, make_maths_m2_questions_and_answers, make_maths_m3_questions_and_answers
 from MathsMechInterp.MathsTestQuestions import make_maths_n1_questions_and_answers, make_maths_n2_questions_and_answers, make_maths_n3_questions_and_answers, make_maths_n4_questions_and_answers
-from MathsMechInterp.maths_complexity import get_maths_min_complexity
+from MathsMechInterp.maths_complexity import (SimpleQuestionDescriptor, QuestionBatch, get_maths_min_complexity, get_maths_question_complexity, get_maths_question_complexity_batch,
+    MATHS_COMPLEXITY_MAJOR_TAGS, MATHS_COMPLEXITY_MINOR_TAGS, get_maths_complexity_codes, maths_complexity_code_to_tags, get_maths_node_operation_coverage, get_maths_nodes_operation_coverage)
 from MathsMechInterp.maths_search_mix import (
     run_intervention_core, run_strong_intervention, run_weak_intervention,
     opr_functions, sgn_functions)
@@ -23,6 +41,11 @@ from MathsMechInterp.maths_search_sub import (
     sub_mt_functions, sub_gt_functions, sub_md_functions, sub_mb_functions, neg_nd_functions, neg_nb_functions)
 
 
+# A model that fails on every batch. Defined at module level so it can be pickled for worker processes
+def raising_model(tokens):
+    raise ValueError("Model failed")
+
+
 class TestMaths(unittest.TestCase):
 
     def get_cfg(self):
@@ -35,6 +58,24 @@ class TestMaths(unittest.TestCase):
         return cfg
 
 
+    def get_mixed_cfg_and_questions(self):
+        # A config with addition and subtraction questions, and one seeded batch of its questions
+        cfg = self.get_cfg()
+        cfg.perc_sub = 50
+        questions = maths_data_generator_mixed_core(cfg, True, rng=torch.Generator().manual_seed(cfg.analysis_seed))
+        return cfg, questions
+
+
+    def get_sign_error_model(self, cfg):
+        # A fake model that predicts every next token, except the answer sign is wrong when the first question digit is 7
+        def model(tokens):
+            logits = torch.nn.functional.one_hot(torch.roll(tokens, -1, 1), MathsToken.MAX_INDEX + 1).float() * 10
+            wrong = tokens[:, 0] == 7
+            logits[wrong, cfg.num_question_positions - 1] = logits[wrong, cfg.num_question_positions - 1].roll(1, dims=-1)
+            return logits
+        return model
+
+
     def test_to_dict(self):
         cfg = self.get_cfg()    
         data = cfg.to_dict()    
@@ -60,6 +101,14 @@ class TestMaths(unittest.TestCase):
         cfg = self.get_cfg()
         self.assertEqual( int_to_answer_str(cfg, 1234), "+0001234" )
 
+
+    def test_answers_to_tokens(self):
+        cfg = self.get_cfg()
+        tokens = answers_to_tokens(cfg, torch.tensor([1234, -56, 0]))
+        self.assertEqual( tokens_to_string(cfg, tokens[0]), "+0001234" )
+        self.assertEqual( tokens_to_string(cfg, tokens[1]), "-0000056" )
+        self.assertEqual( tokens_to_string(cfg, tokens[2]), "+0000000" )
+
         
     def test_tokens_to_unsigned_int(self):
         q = [0,1,2,3,4,5]
@@ -68,6 +117,27 @@ class TestMaths(unittest.TestCase):
         self.assertEqual( tokens_to_unsigned_int(q, offset, digits), 12345 )
 
 
+    # Answers are calculated column by column, so work for n_digits beyond what int64 can hold
+    def test_column_answers_to_tokens(self):
+        cfg = self.get_cfg()
+        cfg.n_digits = 12
+        cfg.initialize_maths_token_positions()
+
+        x = torch.tensor([[9,9,9,9,9,9,9,9,9,9,9,9], [0,0,0,0,0,0,1,2,3,4,5,6]])
+        y = torch.tensor([[0,0,0,0,0,0,0,0,0,0,0,1], [0,0,0,0,0,1,0,0,0,0,0,0]])
+        
+        tokens = column_answers_to_tokens(cfg, x, MathsToken.PLUS, y)
+        self.assertEqual( tokens_to_string(cfg, tokens[0]), "+1000000000000" )
+        self.assertEqual( tokens_to_string(cfg, tokens[1]), "+0000001123456" )
+
+        tokens = column_answers_to_tokens(cfg, x, MathsToken.MINUS, y)
+        self.assertEqual( tokens_to_string(cfg, tokens[0]), "+0999999999998" )
+        self.assertEqual( tokens_to_string(cfg, tokens[1]), "-0000000876544" )
+
+        tokens = column_answers_to_tokens(cfg, x[1:], MathsToken.MULT, x[1:])
+        self.assertEqual( tokens_to_string(cfg, tokens[0]), "+0015241383936" )
+
+
     def test_set_maths_vocabulary(self):
         cfg = self.get_cfg()
 
@@ -105,6 +175,19 @@ class TestMaths(unittest.TestCase):
         make_maths_n3_questions_and_answers(cfg)
         make_maths_n4_questions_and_answers(cfg)
           
+
+    def test_make_maths_questions_and_answers_bulk(self):
+        cfg = self.get_cfg()
+
+        # Accepts an [N, 2] tensor. Skips operands that do not fit in n_digits and questions of the wrong complexity
+        pairs = torch.tensor([[123, 456], [1000000, 1], [155, 105], [999999, 1]])
+        questions = make_maths_questions_and_answers(cfg, MathsToken.PLUS, QType.MATH_ADD, MathsBehavior.ADD_S1_TAG, pairs)
+        self.assertEqual( questions.shape, (1, cfg.n_ctx) )
+        self.assertEqual( questions[0, :cfg.n_digits].tolist(), [0, 0, 0, 1, 5, 5] )
+        self.assertTrue( torch.equal(questions[:, cfg.num_question_positions:], answers_to_tokens(cfg, torch.tensor([260]))) )
+
+        questions = make_maths_questions_and_answers(cfg, MathsToken.MINUS, QType.UNKNOWN, MathsBehavior.UNKNOWN, pairs)
+        self.assertTrue( torch.equal(questions[:, cfg.num_question_positions:], answers_to_tokens(cfg, torch.tensor([-333, 50, 999998]))) )
         
     def test_maths_data_generator_single(self):
         
@@ -122,6 +205,617 @@ class TestMaths(unittest.TestCase):
         questions = maths_data_generator_mixed_core( cfg, False )
         questions = maths_data_generator_mixed_core( cfg, True )
         
+
+    def test_maths_data_generator_device(self):
+        
+        cfg = self.get_cfg()
+        cfg.data_device_name = "cpu"
+        self.assertEqual( cfg.data_device, torch.device("cpu") )
+
+        questions = next(maths_data_generator_mixed(cfg))
+        self.assertEqual( questions.device, torch.device("cpu") )
+        self.assertEqual( questions.shape, (cfg.batch_size, cfg.n_ctx) )
+
+
+
+    def test_maths_data_generator_prefetch(self):
+        
+        cfg = self.get_cfg()
+        cfg.set_seed(cfg.analysis_seed)
+
+        with maths_data_generator_mixed_prefetch(cfg, enrich_data=True, depth=2) as ds:
+            for _ in range(4):
+                questions = next(ds)
+                self.assertEqual( questions.shape, (cfg.batch_size, cfg.n_ctx) )
+
+        self.assertFalse( ds.thread.is_alive() )
+
+
+
+    def test_mixed_maths_dataloader_workers(self):
+        
+        cfg = self.get_cfg()
+        
+        # Two workers share the budget of 4 batches, and the same seed gives the same questions
+        questions1 = torch.cat(list(get_mixed_maths_dataloader(cfg, num_batches=4, num_workers=2, seed=123)))
+        questions2 = torch.cat(list(get_mixed_maths_dataloader(cfg, num_batches=4, num_workers=2, seed=123)))
+        self.assertEqual( questions1.shape, (4 * cfg.batch_size, cfg.n_ctx) )
+        self.assertTrue( torch.equal(questions1, questions2) )
+
+        # The questions do not depend on the number of workers
+        questions3 = torch.cat(list(get_mixed_maths_dataloader(cfg, num_batches=4, num_workers=0, seed=123)))
+        self.assertTrue( torch.equal(questions1, questions3) )
+
+        # Worker processes (even a single one) use the cfg.analysis_seed stream, not the global RNG state
+        questions4 = torch.cat(list(get_mixed_maths_dataloader(cfg, num_batches=4, num_workers=1)))
+        questions5 = torch.cat(list(get_mixed_maths_dataloader(cfg, num_batches=4, num_workers=2)))
+        self.assertTrue( torch.equal(questions4, questions5) )
+
+
+    def test_maths_data_generator_compact_tokens(self):
+        
+        cfg = self.get_cfg()
+        questions = maths_data_generator_batch_at(cfg, 123, 0, mixed=True)
+
+        cfg.compact_tokens = True
+        compact_questions = maths_data_generator_batch_at(cfg, 123, 0, mixed=True)
+        self.assertEqual( compact_questions.dtype, torch.uint8 )
+        self.assertTrue( torch.equal(widen_tokens(compact_questions), questions) )
+
+        # Complexity is calculated on the widened tokens, so the uint8 questions still pass their complexity checks
+        self.assertEqual( make_maths_s5_questions_and_answers(cfg).dtype, torch.uint8 )
+        self.assertEqual( make_maths_n4_questions_and_answers(cfg).dtype, torch.uint8 )
+
+
+    def test_maths_data_store(self):
+        
+        cfg = self.get_cfg()
+        batches = list(maths_data_generator_indexed(cfg, seed=123, stop_index=3))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            the_file_name = os.path.join(temp_dir, "questions.bin")
+            write_maths_data_store(cfg, the_file_name, batches, 3, "unit test")
+
+            dataset = MmapMathsDataset(the_file_name, cfg)
+            self.assertEqual( len(dataset), 3 )
+            self.assertEqual( dataset.header['description'], "unit test" )
+            for i in range(3):
+                self.assertTrue( torch.equal(dataset[i], batches[i]) )
+            del dataset
+
+
+    def test_maths_data_generator_indexed(self):
+        
+        cfg = self.get_cfg()
+        
+        # Any batch of the counter-based stream can be regenerated without replaying the batches before it
+        batches = list(maths_data_generator_indexed(cfg, seed=123, start_index=10, stop_index=15))
+        self.assertEqual( len(batches), 5 )
+        self.assertTrue( torch.equal(batches[3], maths_data_generator_batch_at(cfg, 123, 13)) )
+        self.assertFalse( torch.equal(batches[3], maths_data_generator_batch_at(cfg, 124, 13)) )
+
+        # With on_cpu, the stream is generated on the CPU (whatever cfg.data_device is) and each batch moved to cfg.data_device
+        cfg.data_device_name = "meta"
+        batches = list(maths_data_generator_indexed(cfg, seed=123, start_index=10, stop_index=15, on_cpu=True))
+        self.assertEqual( batches[3].device.type, "meta" )
+        cfg.data_device_name = "cpu"
+        self.assertTrue( torch.equal(next(maths_data_generator_indexed(cfg, seed=123, start_index=13, on_cpu=True)), maths_data_generator_batch_at(cfg, 123, 13)) )
+
+
+    def test_maths_data_generator_stratified(self):
+
+        cfg = self.get_cfg()
+        rng = torch.Generator().manual_seed(cfg.analysis_seed)
+
+        # Each question is constructed to be of the requested complexity class, in the requested proportions
+        class_weights = {MathsBehavior.ADD_S5_TAG: 1, MathsBehavior.SUB_M4_TAG: 1, MathsBehavior.NEG_N2_TAG: 2}
+        questions = maths_data_generator_stratified_core(cfg, class_weights, rng=rng)
+        self.assertEqual( questions.shape, (cfg.batch_size, cfg.n_ctx) )
+
+        tags = [get_maths_question_complexity(cfg, question)[1] for question in questions]
+        self.assertEqual( tags.count(MathsBehavior.ADD_S5_TAG), cfg.batch_size // 4 )
+        self.assertEqual( tags.count(MathsBehavior.SUB_M4_TAG), cfg.batch_size // 4 )
+        self.assertEqual( tags.count(MathsBehavior.NEG_N2_TAG), cfg.batch_size // 2 )
+
+
+    def test_get_maths_question_complexity_batch(self):
+
+        cfg = self.get_cfg()
+        cfg.perc_sub = 50
+        rng = torch.Generator().manual_seed(cfg.analysis_seed)
+
+        # The batched classifier agrees with the per-question classifier, including rare cascade classes
+        questions = torch.cat([
+            maths_data_generator_mixed_core(cfg, True, rng=rng),
+            maths_data_generator_stratified_core(cfg, {MathsBehavior.ADD_S5_TAG: 1, MathsBehavior.SUB_M4_TAG: 1, MathsBehavior.NEG_N4_TAG: 1}, rng=rng)])
+        major, minor = get_maths_question_complexity_batch(cfg, questions)
+        for i, question in enumerate(questions):
+            major_tag, minor_tag = get_maths_question_complexity(cfg, question)
+            self.assertEqual( MATHS_COMPLEXITY_MAJOR_TAGS[major[i]], major_tag )
+            self.assertEqual( MATHS_COMPLEXITY_MINOR_TAGS[minor[i]], minor_tag )
+
+        # An empty batch (e.g. a question bank with no questions that fit in n_digits) classifies as empty
+        major, minor = get_maths_question_complexity_batch(cfg, questions[:0])
+        self.assertEqual( major.shape, (0,) )
+        self.assertEqual( minor.shape, (0,) )
+
+        cfg.n_digits = 3
+        cfg.initialize_maths_token_positions()
+        self.assertEqual( make_maths_s5_questions_and_answers(cfg).shape, (0, cfg.n_ctx) )
+
+
+    def test_profile_maths_data_generator(self):
+
+        cfg = self.get_cfg()
+
+        # The profile of a stratified generator reproduces its requested class mix
+        class_weights = {MathsBehavior.ADD_S0_TAG: 1, MathsBehavior.SUB_M2_TAG: 3}
+        profile = profile_maths_data_generator(cfg, maths_data_generator_stratified(cfg, class_weights), num_batches=5, show=False)
+        self.assertEqual( len(profile), 2 )
+        count, freq, low, high = profile[(QType.MATH_ADD, MathsBehavior.ADD_S0_TAG)]
+        self.assertEqual( count, 5 * cfg.batch_size // 4 )
+        self.assertTrue( low < freq == 0.25 < high )
+
+        profile = profile_maths_data_generator(cfg, maths_data_generator_mixed(cfg, True), num_batches=5, show=False)
+        self.assertEqual( sum(count for count, _, _, _ in profile.values()), 5 * cfg.batch_size )
+
+
+    def test_question_batch(self):
+
+        cfg = self.get_cfg()
+        cfg.perc_sub = 50
+        cfg.perc_mult = 20
+        questions = maths_data_generator_mixed_core(cfg, True, rng=torch.Generator().manual_seed(cfg.analysis_seed))
+
+        # Decodes the same values as SimpleQuestionDescriptor, and encodes back to the same tokens
+        batch = QuestionBatch.from_tensor(cfg, questions)
+        self.assertEqual( len(batch), cfg.batch_size )
+        for i in range(0, cfg.batch_size, 7):
+            expected = SimpleQuestionDescriptor.from_tensor(cfg, questions[i])
+            self.assertEqual( str(batch.descriptor(i)), str(expected) )
+        self.assertTrue( torch.equal(batch.to_tensor(cfg), questions) )
+
+        # Filter by mask
+        negative = batch[batch.answers < 0]
+        self.assertTrue( len(negative) > 0 )
+        self.assertTrue( torch.all(negative.operators == MathsToken.MINUS) )
+        self.assertTrue( torch.all(negative.first_values < negative.second_values) )
+
+
+    def test_mult_question_complexity(self):
+
+        cfg = self.get_cfg()
+
+        # Multiplication questions are classified by the number of long multiplication columns that generate a carry
+        self.assertEqual( len(make_maths_questions_and_answers(cfg, MathsToken.MULT, QType.MATH, MathsBehavior.MUL_P0_TAG, [[1203, 3], [0, 999999]])), 2 )
+        self.assertEqual( len(make_maths_questions_and_answers(cfg, MathsToken.MULT, QType.MATH, MathsBehavior.MUL_P1_TAG, [[15, 3], [16, 2]])), 2 )
+        self.assertEqual( len(make_maths_questions_and_answers(cfg, MathsToken.MULT, QType.MATH, MathsBehavior.MUL_P4_TAG, [[999, 999]])), 1 )
+
+        questions = make_maths_questions_and_answers(cfg, MathsToken.MULT, QType.UNKNOWN, MathsBehavior.UNKNOWN, [[25, 4], [999, 999]])
+        self.assertEqual( get_maths_question_complexity(cfg, questions[0]), (QType.MATH, MathsBehavior.MUL_P2_TAG) )
+        self.assertEqual( get_maths_question_complexity(cfg, questions[1]), (QType.MATH, MathsBehavior.MUL_P4_TAG) )
+
+
+    def test_maths_data_generator_exhaustive(self):
+
+        cfg = self.get_cfg()
+        cfg.n_digits = 2
+        cfg.initialize_maths_token_positions()
+
+        # Every question appears exactly once, in chunks of the requested size
+        chunks = list(maths_data_generator_exhaustive(cfg, MathsToken.MINUS, chunk_size=3000))
+        self.assertEqual( [len(chunk) for chunk in chunks], [3000, 3000, 3000, 1000] )
+        questions = torch.cat(chunks)
+        self.assertEqual( len(torch.unique(questions, dim=0)), 10000 )
+        self.assertEqual( questions[1234, :cfg.n_digits].tolist(), [1, 2] )
+        self.assertTrue( torch.equal(questions[1234, cfg.num_question_positions:], answers_to_tokens(cfg, torch.tensor([12 - 34]))[0]) )
+
+        # Multiplication operands have n_digits//2 leading zeros (as in training), so every product fits in the answer
+        questions = torch.cat(list(maths_data_generator_exhaustive(cfg, MathsToken.MULT)))
+        self.assertEqual( len(questions), maths_exhaustive_num_questions(cfg, MathsToken.MULT) )
+        self.assertEqual( len(questions), 100 )
+        self.assertEqual( questions[99, :cfg.n_digits].tolist(), [0, 9] )
+        self.assertTrue( torch.equal(questions[99, cfg.num_question_positions:], answers_to_tokens(cfg, torch.tensor([9 * 9]))[0]) )
+
+
+    def test_correctness_exhaustive(self):
+
+        cfg, _ = self.get_mixed_cfg_and_questions()
+        cfg.n_digits = 2
+        cfg.initialize_maths_token_positions()
+        cfg.main_model = self.get_sign_error_model(cfg)
+        acfg = types.SimpleNamespace(show_test_failures=False)
+
+        # Every 2 digit addition and subtraction question is tested. The questions with first digit 7 (a tenth of them) fail
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = MathsMechInterp.test_correctness_exhaustive(cfg, acfg)
+        add_results = [counts for (major_tag, _), counts in results.items() if major_tag == QType.MATH_ADD]
+        sub_results = [counts for (major_tag, _), counts in results.items() if major_tag in (QType.MATH_SUB, QType.MATH_NEG)]
+        self.assertEqual( [sum(counts) for counts in zip(*add_results)], [10000, 1000] )
+        self.assertEqual( [sum(counts) for counts in zip(*sub_results)], [10000, 1000] )
+
+        # Larger models must opt in explicitly
+        cfg.n_digits = 5
+        with self.assertRaises(AssertionError):
+            MathsMechInterp.test_correctness_exhaustive(cfg, acfg)
+
+
+    def test_get_maths_question_fails(self):
+
+        cfg = self.get_cfg()
+        acfg = types.SimpleNamespace(threshold=0.5)
+        questions = make_maths_questions_and_answers(cfg, MathsToken.PLUS, QType.UNKNOWN, MathsBehavior.UNKNOWN, [[1, 2], [3, 4], [5, 6]])
+
+        # A question fails if its mean answer loss exceeds the threshold and an answer token is wrong
+        answers = questions[:, -cfg.num_answer_positions:].clone()
+        answers[1, -1] = 0
+        answers[2, -1] = 0
+        all_losses_raw = torch.full((3, cfg.num_answer_positions), -0.1)
+        all_losses_raw[1] = -1.0
+        failed = get_maths_question_fails(cfg, acfg, questions, all_losses_raw, answers)
+        self.assertEqual( failed.tolist(), [False, True, False] )
+
+
+    def test_get_nines_decision(self):
+
+        # Four 9s is confirmed once enough questions pass, and ruled out once the 1M question fail budget (100) is exceeded
+        self.assertEqual( get_nines_decision(0, 10000, 1000000, 4)[0], 0 )
+        self.assertEqual( get_nines_decision(0, 50000, 1000000, 4)[0], 1 )
+        self.assertEqual( get_nines_decision(5, 1000, 1000000, 4)[0], -1 )
+        self.assertEqual( get_nines_decision(101, 900000, 1000000, 4)[0], -1 )
+
+        # Six 9s cannot be confirmed within 1M questions (even with no fails), but two fails rule it out
+        self.assertEqual( get_nines_decision(0, 1000000, 1000000, 6)[0], 0 )
+        self.assertEqual( get_nines_decision(2, 20000, 1000000, 6)[0], -1 )
+
+        # Checks are made after 1, 2, 4, 8, ... batches and after the last batch, with less confidence spent on each later check
+        self.assertEqual( [get_nines_check_num(n) for n in [1, 2, 3, 4, 5, 8]], [1, 2, None, 3, None, 4] )
+        self.assertEqual( get_nines_check_num(5, True), 4 )
+        self.assertAlmostEqual( get_nines_check_confidence(0.95, 1), 0.975 )
+        self.assertLess( get_nines_check_confidence(0.95, 1), get_nines_check_confidence(0.95, 2) )
+
+
+    def test_get_nines_decision_repeated_checks(self):
+
+        # Simulate many runs of a model whose failure rate is exactly the two 9s target (so confirming it is a false confirm),
+        # checking the decision as test_correctness_on_num_questions_core does, after each batch.
+        torch.manual_seed(1234)
+        num_runs, num_batches, batch_size, target_nines, confidence = 400, 1000, 100, 2, 0.95
+        cumulative_fails = torch.distributions.Binomial(batch_size, torch.tensor(0.01)).sample((num_runs, num_batches)).cumsum(dim=1).int().tolist()
+
+        def false_confirm_rate(sequential):
+            false_confirms = 0
+            for run_fails in cumulative_fails:
+                for batch in range(1, num_batches + 1):
+                    check_num = get_nines_check_num(batch, batch == num_batches) if sequential else None
+                    if sequential and check_num is None:
+                        continue
+                    decision = get_nines_decision(run_fails[batch - 1], batch * batch_size, 10 ** 8, target_nines, confidence, check_num)[0]
+                    if decision != 0:
+                        false_confirms += decision > 0
+                        break
+            return false_confirms / num_runs
+
+        # Checking after every batch at the full confidence confirms the borderline model far more often than the 5% allowed.
+        # With the confidence split across geometrically spaced checks, the overall false confirm rate stays within it.
+        self.assertGreater( false_confirm_rate(False), 1 - confidence )
+        self.assertLessEqual( false_confirm_rate(True), 1 - confidence )
+
+
+    def test_nines_fail_budget_early_stop(self):
+
+        cfg, _ = self.get_mixed_cfg_and_questions()
+        cfg.main_model = self.get_sign_error_model(cfg)
+        acfg = types.SimpleNamespace(threshold=0.1, show_test_failures=False)
+        num_questions, target_nines = 20 * cfg.batch_size, 1.1 # A fail budget of 7.9%, a little below the model's fail rate
+
+        # The fail budget is checked after every batch, so the run stops as soon as it is exceeded (rather than at the next check)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            the_successes, the_fails = MathsMechInterp.test_correctness_on_num_questions_core(cfg, acfg, num_questions=num_questions, target_nines=target_nines)
+            num_batches = the_successes // cfg.batch_size
+            _, fails_before = MathsMechInterp.test_correctness_on_num_questions_core(cfg, acfg, num_questions=num_questions, stop_batch=num_batches - 1)
+        self.assertIsNone( get_nines_check_num(num_batches) )
+        self.assertGreater( the_fails, get_nines_fail_budget(num_questions, target_nines) )
+        self.assertLessEqual( fails_before, get_nines_fail_budget(num_questions, target_nines) )
+        self.assertIn( "exceeds the fail budget", output.getvalue() )
+
+
+    def test_nines_decision_resume(self):
+
+        cfg, _ = self.get_mixed_cfg_and_questions()
+        cfg.main_model = self.get_sign_error_model(cfg)
+        acfg = types.SimpleNamespace(threshold=0.1, show_test_failures=False)
+
+        # Re-running a run that stopped early reports the saved decision again, rather than testing more batches
+        with tempfile.TemporaryDirectory() as folder:
+            state_file = os.path.join(folder, "state.json")
+            results = []
+            for _ in range(3):
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    results.append(MathsMechInterp.test_correctness_on_num_questions_core(cfg, acfg, num_questions=20 * cfg.batch_size, target_nines=1.1, state_file=state_file))
+                self.assertIn( "Model does not have 1.1 9s accuracy", output.getvalue() )
+            self.assertEqual( results[1], results[0] )
+            self.assertEqual( results[2], results[0] )
+
+            state = MathsMechInterp.load_correctness_state(state_file)
+            self.assertEqual( state['decision'], -1 )
+            self.assertEqual( state['next_batch'], results[0][0] // cfg.batch_size )
+
+            # The saved decision only holds for the target it was made for
+            with self.assertRaises(AssertionError):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    MathsMechInterp.test_correctness_on_num_questions_core(cfg, acfg, num_questions=20 * cfg.batch_size, target_nines=2, state_file=state_file)
+
+
+    def test_maths_failure_corpus(self):
+
+        cfg, questions = self.get_mixed_cfg_and_questions()
+        model_answers = questions[:, -cfg.num_answer_positions:].flip(1)
+        losses_raw = -torch.rand((cfg.batch_size, cfg.num_answer_positions))
+
+        with tempfile.TemporaryDirectory() as folder:
+            file_name = os.path.join(folder, "fails.bin")
+
+            # Failures are appended batch by batch, and loaded back as a single tensor
+            append_maths_failure_corpus(cfg, file_name, questions[:20], model_answers[:20], losses_raw[:20])
+            append_maths_failure_corpus(cfg, file_name, questions[20:], model_answers[20:], losses_raw[20:])
+            corpus = load_maths_failure_corpus(file_name, cfg)
+            self.assertEqual( corpus.shape[0], cfg.batch_size )
+
+            loaded_questions, loaded_answers, loaded_losses, loaded_codes = split_maths_failure_corpus(cfg, corpus)
+            self.assertTrue( torch.equal(loaded_questions, widen_tokens(questions)) )
+            self.assertTrue( torch.equal(loaded_answers, widen_tokens(model_answers)) )
+            self.assertTrue( torch.equal(loaded_losses, losses_raw) )
+            self.assertTrue( torch.equal(loaded_codes, get_maths_complexity_codes(cfg, questions)) )
+
+            # The corpus shares the maths data file header layout, but is not mistaken for a maths data store
+            with self.assertRaises(AssertionError):
+                read_maths_data_store_header(file_name)
+
+
+    def test_correctness_resume_failure_corpus(self):
+
+        cfg, _ = self.get_mixed_cfg_and_questions()
+        cfg.main_model = self.get_sign_error_model(cfg)
+        acfg = types.SimpleNamespace(threshold=0.1, show_test_failures=False)
+
+        with tempfile.TemporaryDirectory() as folder:
+            state_file_prefix = os.path.join(folder, "state")
+            state_files = [state_file_prefix + "_add.json", state_file_prefix + "_sub.json"]
+            corpus_files = [os.path.join(folder, "fails_add.bin"), os.path.join(folder, "fails_sub.bin")]
+
+            def run():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    MathsMechInterp.test_correctness_on_num_questions(cfg, acfg, num_questions=10 * cfg.batch_size,
+                        state_file_prefix=state_file_prefix, failure_corpus=os.path.join(folder, "fails.bin"))
+                return [load_maths_failure_corpus(corpus_file, cfg).clone() for corpus_file in corpus_files]
+
+            # Each operation's failures go to its own corpus, matching the failures in its state file
+            first = run()
+            for state_file, corpus_file, corpus in zip(state_files, corpus_files, first):
+                state = MathsMechInterp.load_correctness_state(state_file)
+                self.assertGreater( corpus.shape[0], 0 )
+                self.assertEqual( split_maths_failure_corpus(cfg, corpus)[0].tolist(), state['failures'] )
+                self.assertEqual( state['failure_corpus_bytes'], os.path.getsize(corpus_file) )
+
+            # Resuming drops the add failures appended after the last checkpoint, without touching the sub failures,
+            # and a stale saved sub corpus size larger than the file does not extend it
+            add_questions, add_answers, add_losses, _ = split_maths_failure_corpus(cfg, first[0])
+            append_maths_failure_corpus(cfg, corpus_files[0], add_questions, add_answers, add_losses)
+            state = MathsMechInterp.load_correctness_state(state_files[1])
+            state['failure_corpus_bytes'] += 1000000
+            save_correctness_state(state_files[1], state)
+            resumed = run()
+            for corpus, resumed_corpus in zip(first, resumed):
+                self.assertTrue( torch.equal(corpus, resumed_corpus) )
+
+            # A new run (no state files) starts new corpora, rather than appending to the old ones
+            for state_file in state_files:
+                os.remove(state_file)
+            rerun = run()
+            for corpus, rerun_corpus in zip(first, rerun):
+                self.assertTrue( torch.equal(corpus, rerun_corpus) )
+
+
+    def test_maths_questions_by_complexity(self):
+
+        cfg, questions = self.get_mixed_cfg_and_questions()
+        cfg.main_model = self.get_sign_error_model(cfg)
+        acfg = types.SimpleNamespace(show_test_failures=False, print_prediction_success_rate=lambda: None)
+        wrong = questions[:, 0] == 7
+        self.assertTrue( 0 < int(wrong.sum()) < len(questions) )
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            remaining = MathsMechInterp.test_maths_questions_by_complexity(cfg, acfg, questions)
+
+        # The failed questions are removed from the returned questions
+        self.assertTrue( torch.equal(remaining, questions[~wrong]) )
+
+        # The printed good and bad counts per complexity group
+        codes = get_maths_complexity_codes(cfg, questions)
+        expected_lines = []
+        for code in torch.unique(codes).tolist():
+            major_tag, minor_tag = maths_complexity_code_to_tags(code)
+            good = int(((codes == code) & ~wrong).sum())
+            bad = int(((codes == code) & wrong).sum())
+            expected_lines.append(f"Group {major_tag.value}.{minor_tag.value}: Success Rate = {100 * good / (good + bad):.2f}% ({good} good, {bad} bad)")
+        self.assertEqual( [line for line in output.getvalue().splitlines() if line.startswith("Group ")], expected_lines )
+        self.assertEqual( acfg.num_varied_questions, len(questions) )
+        self.assertEqual( acfg.num_varied_successes, len(questions) - int(wrong.sum()) )
+
+
+    def test_predict_maths_questions(self):
+
+        cfg, questions = self.get_mixed_cfg_and_questions()
+        cfg.main_model = lambda tokens: torch.nn.functional.one_hot(torch.roll(tokens, -1, 1), MathsToken.MAX_INDEX + 1).float() # Predicts every next token
+
+        # Evaluating in chunks gives the same results as evaluating all the questions at once
+        all_losses_raw, all_max_prob_tokens = predict_maths_questions(cfg, questions, batch_size=cfg.batch_size)
+        chunk_losses_raw, chunk_max_prob_tokens = predict_maths_questions(cfg, questions, batch_size=7)
+        self.assertTrue( torch.equal(chunk_max_prob_tokens, all_max_prob_tokens) )
+        self.assertTrue( torch.allclose(chunk_losses_raw, all_losses_raw) )
+        self.assertTrue( torch.equal(all_max_prob_tokens, widen_tokens(questions[:, -cfg.num_answer_positions:])) )
+
+        # The evaluation batch size found for a model is cached, but the cache does not keep the model alive
+        self.assertEqual( get_maths_eval_batch_size(cfg), get_maths_eval_batch_size(cfg) )
+        model_ref = weakref.ref(cfg.main_model)
+        cfg.main_model = None
+        gc.collect()
+        self.assertIsNone( model_ref() )
+
+
+    def test_maths_stacked_ablation_hooks(self):
+
+        cfg = self.get_cfg()
+        acfg = types.SimpleNamespace(
+            l_attn_hook_z_name=[f'blocks.{layer}.attn.hook_z' for layer in range(cfg.n_layers)],
+            l_mlp_hook_post_name=[f'blocks.{layer}.mlp.hook_post' for layer in range(cfg.n_layers)])
+        num_questions, n_heads, d_head, d_mlp = 5, 3, 4, 8
+        mean_values = {}
+        for name in acfg.l_attn_hook_z_name:
+            mean_values[name] = torch.rand((cfg.n_ctx, n_heads, d_head))
+        for name in acfg.l_mlp_hook_post_name:
+            mean_values[name] = torch.rand((cfg.n_ctx, d_mlp))
+
+        # Each replica of the stacked batch has a different node ablated
+        node_locations = [NodeLocation(3, 0, True, 2), NodeLocation(7, 0, True, 0), NodeLocation(3, 0, False, 0), NodeLocation(9, 1, True, 1)]
+        the_hooks = dict(get_maths_stacked_ablation_hooks(cfg, acfg, node_locations, num_questions, mean_values))
+        self.assertEqual( sorted(the_hooks.keys()), ['blocks.0.attn.hook_z', 'blocks.0.mlp.hook_post', 'blocks.1.attn.hook_z'] )
+
+        z = torch.zeros((len(node_locations) * num_questions, cfg.n_ctx, n_heads, d_head))
+        z = the_hooks['blocks.0.attn.hook_z'](z, types.SimpleNamespace(name='blocks.0.attn.hook_z')).view(len(node_locations), num_questions, cfg.n_ctx, n_heads, d_head)
+        self.assertTrue( torch.equal(z[0, :, 3, 2], mean_values['blocks.0.attn.hook_z'][3, 2].expand(num_questions, d_head)) )
+        self.assertTrue( torch.equal(z[1, :, 7, 0], mean_values['blocks.0.attn.hook_z'][7, 0].expand(num_questions, d_head)) )
+        self.assertEqual( int(torch.count_nonzero(z)), 2 * num_questions * d_head )
+
+        post = torch.zeros((len(node_locations) * num_questions, cfg.n_ctx, d_mlp))
+        post = the_hooks['blocks.0.mlp.hook_post'](post, types.SimpleNamespace(name='blocks.0.mlp.hook_post')).view(len(node_locations), num_questions, cfg.n_ctx, d_mlp)
+        self.assertTrue( torch.equal(post[2, :, 3], mean_values['blocks.0.mlp.hook_post'][3].expand(num_questions, d_mlp)) )
+        self.assertEqual( int(torch.count_nonzero(post)), num_questions * d_mlp )
+
+
+    def test_maths_stacked_position_ablation_hooks(self):
+
+        cfg = self.get_cfg()
+        acfg = types.SimpleNamespace(l_hook_resid_post_name=[f'blocks.{layer}.hook_resid_post' for layer in range(cfg.n_layers)])
+        num_questions, d_model = 5, 6
+        mean_values = {acfg.l_hook_resid_post_name[0]: torch.rand((cfg.n_ctx, d_model))}
+
+        # Each replica of the stacked batch has a different position ablated
+        positions = list(range(cfg.n_ctx))
+        [(hook_name, ablate_hook)] = get_maths_stacked_position_ablation_hooks(acfg, positions, num_questions, mean_values)
+        self.assertEqual( hook_name, 'blocks.0.hook_resid_post' )
+
+        resid = torch.zeros((len(positions) * num_questions, cfg.n_ctx, d_model))
+        resid = ablate_hook(resid, types.SimpleNamespace(name=hook_name)).view(len(positions), num_questions, cfg.n_ctx, d_model)
+        for position in positions:
+            self.assertTrue( torch.equal(resid[position, :, position], mean_values[hook_name][position].expand(num_questions, d_model)) )
+        self.assertEqual( int(torch.count_nonzero(resid)), len(positions) * num_questions * d_model )
+
+
+    def test_maths_questions_by_impact_sweep(self):
+
+        cfg, questions = self.get_mixed_cfg_and_questions()
+        hook_name = 'blocks.0.hook_resid_post'
+        acfg = types.SimpleNamespace(threshold=0.1, show_test_failures=False, ablate_node_locations=[],
+            l_attn_hook_z_name=[], l_mlp_hook_post_name=[], l_hook_resid_post_name=[hook_name])
+
+        # A fake model with one residual stream hook. Predicts every next token, except answer token i is wrong
+        # if question position i has been ablated (so ablating the question positions has a known impact)
+        class PositionSensitiveModel:
+            def __call__(self, tokens):
+                return self.run_with_hooks(tokens)
+
+            def run_with_hooks(self, tokens, return_type="logits", fwd_hooks=()):
+                resid = torch.nn.functional.one_hot(tokens, MathsToken.MAX_INDEX + 1).float()
+                for name, hook in fwd_hooks:
+                    if name == hook_name:
+                        resid = hook(resid, types.SimpleNamespace(name=name))
+                if return_type is None:
+                    return None
+                logits = torch.roll(resid, -1, 1) * 10
+                intact = resid.max(dim=-1).values == 1
+                for i in range(cfg.num_answer_positions):
+                    wrong = ~intact[:, i]
+                    logits[wrong, cfg.num_question_positions - 1 + i] = logits[wrong, cfg.num_question_positions - 1 + i].roll(1, dims=-1)
+                return logits
+        cfg.main_model = PositionSensitiveModel()
+        mean_values = get_maths_node_mean_values(cfg, acfg, questions)
+
+        # The hook that ablates the position in acfg.ablate_node_locations (as per acfg.resid_put_hooks)
+        def resid_put_hook(value, hook):
+            position = acfg.ablate_node_locations[0].position
+            value[:, position] = mean_values[hook.name][position]
+            return value
+        acfg.resid_put_hooks = [(hook_name, resid_put_hook)]
+
+        # The stacked sweep gives the same fail counts and answer impacts as ablating each position in its own forward pass
+        fail_counts, impact_summaries = MathsMechInterp.test_maths_questions_by_impact_sweep(cfg, acfg, questions, mean_values=mean_values)
+        for position in range(cfg.n_ctx):
+            num_fails = MathsMechInterp.test_maths_questions_by_impact(cfg, acfg, questions, position, True)
+            self.assertEqual( int(fail_counts[position]), num_fails )
+
+            failed, _, all_max_prob_tokens = MathsMechInterp.predict_maths_question_fails(cfg, acfg, questions, acfg.resid_put_hooks)
+            impact_fails = "".join(get_question_answer_impact(cfg, questions[i], tokens_to_string(cfg, all_max_prob_tokens[i])) for i in torch.nonzero(failed).flatten().tolist())
+            expected_impact = "A" + sort_unique_digits(impact_fails, True) if impact_fails != "" else ""
+            self.assertEqual( impact_summaries[position], expected_impact )
+
+        # Ablating question position i only makes answer token i wrong
+        self.assertGreater( int(fail_counts[:cfg.num_answer_positions].sum()), 0 )
+        self.assertEqual( impact_summaries[0], "A" + str(cfg.num_answer_positions - 1) )
+
+
+    def test_correctness_of_models(self):
+
+        cfg = self.get_cfg()
+        cfg.main_model = None
+        acfg = types.SimpleNamespace(threshold=0.1, show_test_failures=False)
+        rng = torch.Generator().manual_seed(cfg.analysis_seed)
+        question_batches = [maths_data_generator_mixed_core(cfg, True, rng=rng) for _ in range(3)]
+
+        # One model predicts every next token. The other predicts every token wrongly
+        def perfect_model(tokens):
+            return torch.nn.functional.one_hot(torch.roll(tokens, -1, 1), MathsToken.MAX_INDEX + 1).float() * 10
+        def wrong_model(tokens):
+            return torch.nn.functional.one_hot((torch.roll(tokens, -1, 1) + 1) % (MathsToken.MAX_INDEX + 1), MathsToken.MAX_INDEX + 1).float() * 10
+
+        results = MathsMechInterp.test_correctness_of_models(cfg, acfg, [perfect_model, wrong_model], ["perfect", "wrong"], question_batches=question_batches)
+        self.assertEqual( sum(num_questions for num_questions, _ in results["perfect"].values()), 3 * cfg.batch_size )
+        self.assertEqual( sum(num_fails for _, num_fails in results["perfect"].values()), 0 )
+        self.assertEqual( sum(num_fails for _, num_fails in results["wrong"].values()), 3 * cfg.batch_size )
+        self.assertEqual( results["perfect"].keys(), results["wrong"].keys() )
+        self.assertIsNone( cfg.main_model )
+
+        # A worker process that dies raises an error, rather than leaving the evaluation waiting forever
+        with self.assertRaises(RuntimeError):
+            with contextlib.redirect_stdout(io.StringIO()):
+                MathsMechInterp.test_correctness_of_models(cfg, acfg, [raising_model], question_batches=question_batches, num_workers=1)
+
+
+    def test_merge_correctness_states(self):
+
+        # Correctness runs over separate batch ranges of the same question stream merge into one result
+        stream = {'n_digits': 6, 'perc_sub': 0, 'perc_mult': 0, 'batch_size': 64, 'seed': 345621, 'enrich_data': True, 'num_questions': 6400}
+        with tempfile.TemporaryDirectory() as folder:
+            file_a = os.path.join(folder, "a.json")
+            file_b = os.path.join(folder, "b.json")
+            save_correctness_state(file_a, dict(stream, start_batch=0, stop_batch=60, next_batch=60, the_successes=3840, the_fails=1, failures=[[1]]))
+            save_correctness_state(file_b, dict(stream, start_batch=60, stop_batch=101, next_batch=101, the_successes=2624, the_fails=2, failures=[[2], [3]]))
+
+            merged = merge_correctness_states([file_b, file_a])
+            self.assertEqual( merged['the_successes'], 6464 )
+            self.assertEqual( merged['the_fails'], 3 )
+            self.assertEqual( merged['failures'], [[1], [2], [3]] )
+            self.assertEqual( merged['ranges'], [[0, 60], [60, 101]] )
+
+            # Overlapping ranges are rejected
+            save_correctness_state(file_b, dict(stream, start_batch=50, stop_batch=101, next_batch=101, the_successes=3264, the_fails=2, failures=[[2], [3]]))
+            with self.assertRaises(AssertionError):
+                merge_correctness_states([file_a, file_b])
+
   
     def test_maths_data_generator_mixed(self):
         
@@ -133,6 +827,13 @@ class TestMaths(unittest.TestCase):
         questions = maths_data_generator_mixed_core(cfg, False)
         questions = maths_data_generator_mixed_core(cfg, True)
 
+        # Exactly the requested number of questions of each operation are generated
+        questions = maths_data_generator_mixed_core(cfg, True, shuffle=True)
+        operators = questions[:, cfg.n_digits]
+        self.assertEqual( questions.shape, (cfg.batch_size, cfg.n_ctx) )
+        self.assertEqual( int((operators == MathsToken.MULT).sum()), cfg.batch_size * 33 // 100 )
+        self.assertEqual( int((operators == MathsToken.MINUS).sum()), cfg.batch_size * 33 // 100 )
+
         #print( tokens_to_string(cfg, questions[0]) )
         #print( tokens_to_string(cfg, questions[1]) )
         #print( tokens_to_string(cfg, questions[2]) )
@@ -414,6 +1115,22 @@ class TestMaths(unittest.TestCase):
         self.assertEqual( node_add_complexity, "S123")
         self.assertEqual( node_sub_complexity, "M123")
         self.assertEqual( node_neg_complexity, "")
+
+
+    def test_useful_node_list_operation_coverage(self):
+
+        cfg, the_list = self.get_useful_node_list()
+
+        # Multiplication complexity tags (stored under the generic QType.MATH major tag) count as operation coverage
+        the_list.add_node_tag( NodeLocation(18,0,True,0), QType.MATH.value, MathsBehavior.MUL_COMPLEXITY_PREFIX.value + '12' )
+        the_list.add_node_tag( NodeLocation(19,0,True,0), QType.MATH.value, MathsBehavior.MUL_COMPLEXITY_PREFIX.value + '0' )
+        self.assertEqual( get_maths_node_operation_coverage(the_list.get_node(NodeLocation(18,0,True,0))), "SMP" )
+        self.assertEqual( get_maths_node_operation_coverage(the_list.get_node(NodeLocation(18,0,True,3))), "MN" )
+        self.assertEqual( get_maths_node_operation_coverage(the_list.get_node(NodeLocation(19,0,True,0))), "P" )
+
+        num_add, num_sub, num_neg, num_mul, num_triple, num_double, num_single = get_maths_nodes_operation_coverage(the_list.nodes)
+        self.assertEqual( (num_add, num_sub, num_neg, num_mul), (4, 5, 4, 2) )
+        self.assertEqual( (num_triple, num_double, num_single), (4, 1, 1) )
         
 
     def test_useful_node_list_save_load(self):